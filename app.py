@@ -13,6 +13,7 @@ from util import safe_commit
 from util import elapsed
 from util import HTTPMethodOverrideMiddleware
 from util import read_csv_file
+from util import ConsistentHashRing
 
 import logging
 import sys
@@ -61,13 +62,57 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = True  # as instructed, to supress
 app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
 app.config['SQLALCHEMY_ECHO'] = (os.getenv("SQLALCHEMY_ECHO", False) == "True")
 
+# connection pool settings.  each can be set for one heroku process type by prefixing it
+# with the type from $DYNO, like WEB_SQLALCHEMY_POOL_SIZE or RQ_WORKER_QUEUE_0_SQLALCHEMY_POOL_SIZE.
+# a pool size of 0 means no pool: a new connection every time, like we used to.
+db_process_type = os.getenv("DYNO", "").split(".")[0].upper()
+
+def get_db_setting(name, default):
+    if db_process_type and os.getenv(u"{}_{}".format(db_process_type, name)) is not None:
+        return int(os.getenv(u"{}_{}".format(db_process_type, name)))
+    return int(os.getenv(name, default))
+
+db_pool_size = get_db_setting("SQLALCHEMY_POOL_SIZE", 5)
+db_max_overflow = get_db_setting("SQLALCHEMY_MAX_OVERFLOW", 5)
+db_pool_recycle = get_db_setting("SQLALCHEMY_POOL_RECYCLE", 60 * 30)
+
+# pooled connections idle for longer than this get a SELECT 1 before we hand them out
+db_ping_idle_seconds = get_db_setting("SQLALCHEMY_PING_IDLE_SECONDS", 30)
+
+
 # from http://stackoverflow.com/a/12417346/596939
-class NullPoolSQLAlchemy(SQLAlchemy):
+class ConfigurablePoolSQLAlchemy(SQLAlchemy):
     def apply_driver_hacks(self, app, info, options):
-        options['poolclass'] = NullPool
-        return super(NullPoolSQLAlchemy, self).apply_driver_hacks(app, info, options)
-
-db = NullPoolSQLAlchemy(app)
+        if db_pool_size:
+            options['pool_size'] = db_pool_size
+            options['max_overflow'] = db_max_overflow
+            options['pool_recycle'] = db_pool_recycle
+        else:
+            options['poolclass'] = NullPool
+            options.pop('pool_size', None)
+            options.pop('max_overflow', None)
+        return super(ConfigurablePoolSQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+db = ConfigurablePoolSQLAlchemy(app)
+
+
+# pools the parent process had when we forked.  we never touch them, and keep them
+# referenced so their connections are never closed (or garbage collected) from the
+# child: closing one tells postgres to end the parent's session too.
+_pools_from_parent = []
+_db_pid = os.getpid()
+
+def reset_db_after_fork():
+    # call in a forked child before it uses the db
+    global _db_pid
+    if _db_pid == os.getpid():
+        return
+    _db_pid = os.getpid()
+    if db_pool_size:
+        _pools_from_parent.append(db.engine.pool)
+        db.engine.pool = db.engine.pool.recreate()
+    else:
+        db.engine.dispose()
 
 
 # do compression.  has to be above flask debug toolbar so it can override this.
@@ -98,11 +143,20 @@ redis_rq_conn = redis.from_url(
     db=0
 )
 
-for i in range(0, 2):  # number of queues to spin up
+# number of queues to spin up.  objects are spread across them by a consistent hash
+# of their id (see ti_queue_ring), so changing this only moves about 1/n of them.
+num_rq_queues = int(os.getenv("RQ_NUM_QUEUES", 2))
+
+for i in range(0, num_rq_queues):
     ti_queues.append(
         Queue("ti-queue-{}".format(i), connection=redis_rq_conn)
     )
 
+ti_queue_ring = ConsistentHashRing(range(0, num_rq_queues))
+
+# jobs someone is waiting on.  every worker takes from here before its own queue.
+ti_high_priority_queue = Queue("ti-queue-high", connection=redis_rq_conn)
+
 
 # imports got here for tables that need auto-created.
 # from models import temp_orcid_profile
@@ -123,11 +177,38 @@ for i in range(0, 2):  # number of queues to spin up
 
 
 # from http://docs.sqlalchemy.org/en/latest/core/pooling.html
-# This recipe will ensure that a new Connection will succeed even if connections in the pool 
-# have gone stale, provided that the database server is actually running. 
-# The expense is that of an additional execution performed per checkout
+# makes sure a connection we hand out is alive, provided that the database server is actually running.
+# a SELECT 1 on every checkout cost us a round trip per request, so now only connections
+# that have sat in the pool a while get one; pool_recycle retires the old ones anyway.
+# with no pool, every connection is brand new, so there's nothing to check.
+_connections_from_parent = []
+
+@event.listens_for(Pool, "connect")
+def remember_connection_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+@event.listens_for(Pool, "checkin")
+def remember_checkin_time(dbapi_connection, connection_record):
+    if connection_record is not None:
+        connection_record.info["checked_in_at"] = time.time()
+
+
 @event.listens_for(Pool, "checkout")
 def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info.get("pid", os.getpid()) != os.getpid():
+        # a connection from before a fork, in case reset_db_after_fork wasn't called.
+        # don't close it (that would end the parent's session), just never use it.
+        _connections_from_parent.append(dbapi_connection)
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid {}, attempting to check out in pid {}".format(
+                connection_record.info["pid"], os.getpid()))
+
+    checked_in_at = connection_record.info.get("checked_in_at", None)
+    if checked_in_at is None or time.time() - checked_in_at < db_ping_idle_seconds:
+        return
+
     cursor = dbapi_connection.cursor()
     try:
         cursor.execute("SELECT 1")
@@ -140,9 +221,3 @@ def ping_connection(dbapi_connection, connection_record, connection_proxy):
         # connecting again up to three times before raising.
         raise exc.DisconnectionError()
     cursor.close()
-
-
-
-
-
-
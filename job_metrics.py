@@ -0,0 +1,185 @@
+import os
+import json
+import logging
+import threading
+import redis
+from collections import defaultdict
+from contextlib import contextmanager
+from time import time
+
+from app import redis_rq_conn
+from app import ti_queues
+from app import ti_high_priority_queue
+
+
+# what the workers record about every update_fn job, so a run can be watched from anywhere.
+# counters go in one redis hash per update per minute, the latest job durations in a list.
+# see /admin/jobs and  python jobs.py job_stats
+metrics_bucket_seconds = 60
+metrics_keep_seconds = int(os.getenv("JOB_METRICS_KEEP_SECONDS", 60 * 60 * 24))
+num_latencies_kept = 1000
+
+job_metrics_updates_key = "job-metrics-updates"
+
+
+def metrics_bucket_key(update_name, bucket):
+    return u"job-metrics:{}:{}".format(update_name, bucket)
+
+def stage_bucket_key(update_name, bucket):
+    return u"job-stages:{}:{}".format(update_name, bucket)
+
+def latencies_key(update_name):
+    return u"job-latencies:{}".format(update_name)
+
+
+
+# seconds spent in each stage of the job this process is running.  shared by all threads,
+# because call_method_on_all makes provider calls from its own threads.
+_stage_timings = defaultdict(float)
+_stage_timings_lock = threading.Lock()
+
+def start_job_stages():
+    with _stage_timings_lock:
+        _stage_timings.clear()
+
+def get_job_stages():
+    with _stage_timings_lock:
+        return dict(_stage_timings)
+
+
+@contextmanager
+def job_stage(stage_name):
+    # adds the time spent in this block to the job's timing for stage_name
+    start_time = time()
+    try:
+        yield
+    finally:
+        with _stage_timings_lock:
+            _stage_timings[stage_name] += time() - start_time
+
+
+
+def record_job(update_name, seconds, num_objects, num_failures=0, job_failed=False, stage_timings=None):
+    bucket = int(time() / metrics_bucket_seconds) * metrics_bucket_seconds
+    key = metrics_bucket_key(update_name, bucket)
+
+    try:
+        pipe = redis_rq_conn.pipeline()
+        pipe.sadd(job_metrics_updates_key, update_name)
+
+        pipe.hincrby(key, "jobs", 1)
+        pipe.hincrby(key, "objects", num_objects)
+        pipe.hincrby(key, "failures", num_failures)
+        pipe.hincrby(key, "failed_jobs", int(job_failed))
+        pipe.hincrbyfloat(key, "seconds", seconds)
+        pipe.expire(key, metrics_keep_seconds)
+
+        if stage_timings:
+            stages_key = stage_bucket_key(update_name, bucket)
+            for (stage_name, stage_seconds) in stage_timings.iteritems():
+                pipe.hincrbyfloat(stages_key, stage_name, stage_seconds)
+            pipe.expire(stages_key, metrics_keep_seconds)
+
+        if num_objects:
+            pipe.lpush(latencies_key(update_name), json.dumps([round(seconds, 3), num_objects]))
+            pipe.ltrim(latencies_key(update_name), 0, num_latencies_kept - 1)
+            pipe.expire(latencies_key(update_name), metrics_keep_seconds)
+
+        pipe.execute()
+    except redis.RedisError:
+        # metrics are nice to have; never fail a job over them
+        logging.exception(u"couldn't record job metrics for {}".format(update_name))
+
+
+def percentiles(values, percents=(50, 90, 99)):
+    if not values:
+        return {}
+    values = sorted(values)
+    ret = {}
+    for percent in percents:
+        index = min(len(values) - 1, int(len(values) * percent / 100.0))
+        ret[u"p{}".format(percent)] = round(values[index], 3)
+    return ret
+
+
+def get_update_metrics(update_name, minutes=60):
+    now_bucket = int(time() / metrics_bucket_seconds) * metrics_bucket_seconds
+    buckets = [now_bucket - (i * metrics_bucket_seconds) for i in range(minutes)]
+
+    pipe = redis_rq_conn.pipeline()
+    for bucket in buckets:
+        pipe.hgetall(metrics_bucket_key(update_name, bucket))
+    for bucket in buckets:
+        pipe.hgetall(stage_bucket_key(update_name, bucket))
+    pipe.lrange(latencies_key(update_name), 0, -1)
+    results = pipe.execute()
+
+    totals = defaultdict(float)
+    for counts in results[0:len(buckets)]:
+        for (field, value) in counts.iteritems():
+            totals[field] += float(value)
+
+    stage_totals = defaultdict(float)
+    for stage_counts in results[len(buckets):2*len(buckets)]:
+        for (stage_name, value) in stage_counts.iteritems():
+            stage_totals[stage_name] += float(value)
+
+    latencies = [json.loads(row) for row in results[-1]]
+    job_seconds = [seconds for (seconds, num_objects) in latencies]
+    object_seconds = [seconds / num_objects for (seconds, num_objects) in latencies]
+
+    window_hours = minutes / 60.0
+    num_jobs = int(totals["jobs"])
+    ret = {
+        "minutes": minutes,
+        "jobs": num_jobs,
+        "objects": int(totals["objects"]),
+        "failures": int(totals["failures"]),
+        "failed_jobs": int(totals["failed_jobs"]),
+        "jobs_per_hour": int(num_jobs / window_hours),
+        "objects_per_hour": int(totals["objects"] / window_hours),
+        "seconds_per_job": percentiles(job_seconds),
+        "seconds_per_object": percentiles(object_seconds),
+        "stage_seconds_per_job": {}
+    }
+    if num_jobs:
+        for (stage_name, seconds) in stage_totals.iteritems():
+            ret["stage_seconds_per_job"][stage_name] = round(seconds / num_jobs, 3)
+    return ret
+
+
+def get_queue_counts():
+    ret = {ti_high_priority_queue.name: ti_high_priority_queue.count}
+    for queue in ti_queues:
+        ret[queue.name] = queue.count
+    return ret
+
+
+def get_job_metrics(minutes=60, update_name=None):
+    if update_name:
+        update_names = [update_name]
+    else:
+        update_names = sorted(redis_rq_conn.smembers(job_metrics_updates_key))
+
+    updates = {}
+    for name in update_names:
+        updates[name] = get_update_metrics(name, minutes)
+
+    queues = {}
+    jobs_per_hour = sum([u["jobs_per_hour"] for u in updates.values()])
+    for (queue_name, count) in get_queue_counts().iteritems():
+        queues[queue_name] = {"jobs_waiting": count}
+        if count and jobs_per_hour:
+            # rough, because all the updates share the workers
+            queues[queue_name]["mins_to_finish"] = round(count / float(jobs_per_hour) * 60, 1)
+
+    return {
+        "queues": queues,
+        "updates": updates
+    }
+
+
+
+if __name__ == "__main__":
+    # python job_metrics.py  prints the last hour of job metrics
+    print json.dumps(get_job_metrics(), sort_keys=True, indent=4)
@@ -1,45 +1,187 @@
 from time import time
 from time import sleep
+from itertools import islice
+from itertools import chain
 import argparse
 import logging
+import multiprocessing
+import os
+import json
+import random
+import traceback
+import importlib
+import redis
+import weakref
 
 from sqlalchemy.dialects import postgresql
 from sqlalchemy import orm
+from sqlalchemy import event
+from sqlalchemy import text
+from rq.job import Job
+from rq.job import JobStatus
+from rq import Queue
+from rq import Worker
+from rq.utils import utcnow
+from rq import get_current_job
+from rq.timeouts import JobTimeoutException
 
 from app import db
 from app import ti_queues
+from app import ti_queue_ring
+from app import ti_high_priority_queue
+from app import redis_rq_conn
+from app import reset_db_after_fork
+from models.load_profiles import with_load_profile
+from models.person import Person
+from models.person import invalidate_profile_jsons_of_products
+from models.product import Product
 from util import elapsed
-from util import chunks
 from util import safe_commit
+from providers import priority_lane
+from job_metrics import record_job
+from job_metrics import job_stage
+from job_metrics import start_job_stages
+from job_metrics import get_job_stages
+from job_metrics import get_job_metrics
+from leases import acquire_leases
+from leases import extend_leases
+from leases import release_leases
+from leases import queued_lease_seconds
+from update_runs import start_run
+from update_runs import get_run
+from update_runs import add_run_chunks
+from update_runs import set_run_high_water
+from update_runs import mark_run_chunks_done
+from update_runs import get_unfinished_run_chunks
+
+logger = logging.getLogger("ti.jobs")
+
+
+# when no --chunk is given, chunks are sized so each job takes about this long,
+# from how long each object has been taking.  well under the 10 minute rq timeout.
+target_chunk_seconds = int(os.getenv("UPDATE_TARGET_CHUNK_SECONDS", 60))
+max_chunk_size = 1000
+
+def record_job_timing(update_name, num_objects, seconds):
+    # keeps a moving average of seconds per object for each update, in redis
+    if not num_objects:
+        return
+    key = u"job-timing:{}".format(update_name)
+    this_seconds_per_object = seconds / float(num_objects)
+    try:
+        old_seconds_per_object = redis_rq_conn.hget(key, "seconds_per_object")
+        if old_seconds_per_object is None:
+            seconds_per_object = this_seconds_per_object
+        else:
+            seconds_per_object = 0.8 * float(old_seconds_per_object) + 0.2 * this_seconds_per_object
+        redis_rq_conn.hmset(key, {
+            "seconds_per_object": seconds_per_object,
+            "updated": time()
+        })
+    except redis.RedisError:
+        logging.exception(u"couldn't record job timing for {}".format(update_name))
+
+
+def get_seconds_per_object(update_name):
+    # from record_job_timing, or None if this update hasn't run yet
+    try:
+        seconds_per_object = redis_rq_conn.hget(u"job-timing:{}".format(update_name), "seconds_per_object")
+    except redis.RedisError:
+        seconds_per_object = None
+    if not seconds_per_object:
+        return None
+    return float(seconds_per_object)
+
+
+def get_adaptive_chunk_size(update_name, default_chunk_size):
+    seconds_per_object = get_seconds_per_object(update_name)
+    if not seconds_per_object:
+        return default_chunk_size
+
+    chunk_size = int(target_chunk_seconds / max(seconds_per_object, 0.001))
+    return max(1, min(max_chunk_size, chunk_size))
+
+
+def get_queue_seconds_per_object(update_name):
+    # about how long each id queued ahead of a job holds it up, with all the workers going
+    seconds_per_object = get_seconds_per_object(update_name)
+    if not seconds_per_object:
+        return 0
+    try:
+        num_workers = max(1, len(Worker.all(connection=redis_rq_conn)))
+    except redis.RedisError:
+        num_workers = 1
+    return seconds_per_object / num_workers
+
+
+def insert_missing_ids(cls, obj_id_list):
+    # if the queue includes items that aren't in the table, make rows for them,
+    # all in one statement.  assumes a row with just an id is a valid start.
+    sql = text(u"""insert into {table} (id)
+                select unnest(cast(:ids as text[]))
+                on conflict (id) do nothing""".format(table=cls.__table__.name))
+    result = db.session.execute(sql, {"ids": list(obj_id_list)})
+    if result.rowcount:
+        logger.info(u"not all objects were there, so created {} rows".format(result.rowcount))
+
+
+# transactions rolled back with session.rollback(), so run_update_fn can tell a method
+# that rolled back its savepoint from one that committed it
+_rolled_back_transactions = weakref.WeakSet()
+
+@event.listens_for(orm.Session, "after_soft_rollback")
+def remember_soft_rollback(session, previous_transaction):
+    _rolled_back_transactions.add(previous_transaction)
+
+
+def invalidate_profile_json_unless_set(my_person):
+    # whatever the update changed may show on the profile, so its snapshot goes, unless
+    # the update made a new one itself (calculate and refresh do).  see get_profile_json
+    if not orm.attributes.instance_state(my_person).attrs.profile_json.history.has_changes():
+        my_person.invalidate_profile_json()
+
+
+def update_fn(cls, method_name, obj_id_list, shortcut_data=None, index=1, load_columns=None, high_priority=False, run_chunk=None,
+              load_profile=None):
+    # the ids are in flight until we're done with them, see leases.py
+    update_name = u"{}.{}".format(cls.__name__, method_name)
+    extend_leases(update_name, obj_id_list)
+    try:
+        run_update_fn(cls, method_name, obj_id_list, shortcut_data, index, load_columns, high_priority, load_profile)
+    finally:
+        release_leases(update_name, obj_id_list)
+
+    # part of a named run: [run name, chunk number].  see update_runs.py
+    if run_chunk:
+        mark_run_chunks_done(run_chunk[0], [run_chunk[1]])
+    return None  # important for if we use this on RQ
 
 
-
-def update_fn(cls, method_name, obj_id_list, shortcut_data=None, index=1):
-
-    # we are in a fork!  dispose of our engine.
-    # will get a new one automatically
-    db.engine.dispose()
+def run_update_fn(cls, method_name, obj_id_list, shortcut_data=None, index=1, load_columns=None, high_priority=False,
+                  load_profile=None):
+    # if we are in a new fork, get our own connections.  forking rq workers run every
+    # job in a new process, but pre-forked ones (rq_worker.py --processes) reuse theirs.
+    reset_db_after_fork()
 
     start = time()
-
-    q = db.session.query(cls).options(orm.undefer('*')).filter(cls.id.in_(obj_id_list))
-    obj_rows = q.all()
-    num_obj_rows = len(obj_rows)
-
-    # if the queue includes items that aren't in the table, build them
-    # assume they can be built by calling cls(id=id)
-    if num_obj_rows != len(obj_id_list):
-        logger.info(u"not all objects are there, so creating")
-        ids_of_got_objects = [obj.id for obj in obj_rows]
-        for id in obj_id_list:
-            if id not in ids_of_got_objects:
-                new_obj = cls(id=id)
-                db.session.add(new_obj)
-        safe_commit(db)
-        logger.info(u"done")
-
-    q = db.session.query(cls).options(orm.undefer('*')).filter(cls.id.in_(obj_id_list))
-    obj_rows = q.all()
+    update_name = u"{}.{}".format(cls.__name__, method_name)
+    start_job_stages()
+
+    with job_stage("load"):
+        insert_missing_ids(cls, obj_id_list)
+
+        q = db.session.query(cls).filter(cls.id.in_(obj_id_list))
+        if load_profile:
+            # what the update said it needs, see models/load_profiles.py
+            q = with_load_profile(q, load_profile)
+        elif load_columns:
+            # just what the job needs, plus the error column we check below.  anything else,
+            # relationships included, loads lazily if touched.
+            columns = list(load_columns) + [column for column in ["error"] if hasattr(cls, column)]
+            q = q.options(orm.load_only(*columns), orm.lazyload('*'))
+        else:
+            q = q.options(orm.undefer('*'))
+        obj_rows = q.all()
     num_obj_rows = len(obj_rows)
 
     print "{repr}.{method_name}() got {num_obj_rows} objects in {elapsed}sec".format(
@@ -49,37 +191,380 @@ def update_fn(cls, method_name, obj_id_list, shortcut_data=None, index=1):
         elapsed=elapsed(start)
     )
 
-    for count, obj in enumerate(obj_rows):
-        start_time = time()
+    methods_start_time = time()
+    num_failures = 0
+    failures = {}  # id: what went wrong, for the ones we'll retry
+    changed_product_ids = []  # their people's profile snapshots are stale now
+    try:
+        with priority_lane(high_priority):
+            for count, obj in enumerate(obj_rows):
+                start_time = time()
+
+                if obj is None:
+                    return None
+
+                method_to_run = getattr(obj, method_name)
+
+                # logged by id, since a repr can read columns the job didn't load
+                obj_id = obj.id
+                print u"\n***\n{count}: starting {cls_name} {obj_id}.{method_name}() method".format(
+                    count=count + (num_obj_rows*index),
+                    cls_name=cls.__name__,
+                    obj_id=obj_id,
+                    method_name=method_name
+                )
 
-        if obj is None:
-            return None
+                # each object gets a savepoint, so one that breaks only loses its own work
+                savepoint = db.session.begin_nested()
+                try:
+                    if shortcut_data:
+                        method_to_run(shortcut_data)
+                    else:
+                        method_to_run()
+
+                    if savepoint in _rolled_back_transactions:
+                        # its own error handler rolled it back
+                        failures[obj_id] = getattr(obj, "error", None) or u"rolled back"
+                    else:
+                        if cls is Person:
+                            invalidate_profile_json_unless_set(obj)
+                        elif cls is Product:
+                            changed_product_ids.append(obj_id)
+                        # unless it committed itself (save_openness_log and save_email do)
+                        if db.session().transaction is savepoint:
+                            savepoint.commit()
+                except (KeyboardInterrupt, SystemExit, JobTimeoutException):
+                    # a timeout is the whole job's, so the failed job handler retries the chunk
+                    raise
+                except Exception:
+                    logging.exception(u"exception in {} on {}".format(update_name, obj_id))
+                    if savepoint.is_active:
+                        savepoint.rollback()
+                    failures[obj_id] = traceback.format_exc()
+
+                # the methods catch their own errors and leave them here
+                if obj_id in failures or getattr(obj, "error", None):
+                    num_failures += 1
+
+                print u"finished {cls_name} {obj_id}.{method_name}(). took {elapsed}sec".format(
+                    cls_name=cls.__name__,
+                    obj_id=obj_id,
+                    method_name=method_name,
+                    elapsed=elapsed(start_time, 4)
+                )
+    except Exception:
+        record_job(update_name, elapsed(start, 4), num_obj_rows, num_failures=num_obj_rows,
+                   job_failed=True, stage_timings=get_job_stages())
+        raise
+
+    record_job_timing(
+        update_name,
+        num_obj_rows,
+        elapsed(methods_start_time, 4)
+    )
 
-        method_to_run = getattr(obj, method_name)
+    with job_stage("commit"):
+        if changed_product_ids:
+            invalidate_profile_jsons_of_products(changed_product_ids)
+        commit_success = safe_commit(db)
+    if not commit_success:
+        print u"COMMIT fail"
+        failures = dict([(obj_id, u"commit failed") for obj_id in obj_id_list])
+    db.session.remove()  # close connection nicely
 
-        print u"\n***\n{count}: starting {repr}.{method_name}() method".format(
-            count=count + (num_obj_rows*index),
-            repr=obj,
-            method_name=method_name
-        )
+    record_job(update_name, elapsed(start, 4), num_obj_rows, num_failures=num_failures,
+               job_failed=not commit_success, stage_timings=get_job_stages())
 
-        if shortcut_data:
-            method_to_run(shortcut_data)
-        else:
-            method_to_run()
+    # only rq jobs retry; run inline, you see the failures right here
+    if get_current_job():
+        handle_update_failures(cls, method_name, obj_id_list, failures, load_columns, high_priority,
+                               load_profile=load_profile)
+        promote_due_retries()
+    elif failures:
+        print u"{} of {} objects failed: {}".format(len(failures), num_obj_rows, failures.keys())
+
+
+
+# ids that fail in an rq job are retried one at a time, after a backoff that doubles each
+# attempt.  after update_max_retries they go to the dead letter hash for that update
+# with the exception, where  python jobs.py dead_letters Person.refresh  shows them.
+update_max_retries = int(os.getenv("UPDATE_MAX_RETRIES", 3))
+update_retry_backoff_seconds = int(os.getenv("UPDATE_RETRY_BACKOFF_SECONDS", 60))
+
+update_retries_key = "update-retries"  # zset of retries, scored by when they're due
+
+def retry_counts_key(update_name):
+    return u"update-retry-counts:{}".format(update_name)
 
-        print u"finished {repr}.{method_name}(). took {elapsed}sec".format(
-            repr=obj,
-            method_name=method_name,
-            elapsed=elapsed(start_time, 4)
+def dead_letter_key(update_name):
+    return u"dead-letter:{}".format(update_name)
+
+
+def handle_update_failures(cls, method_name, obj_id_list, failures, load_columns=None, high_priority=False, queue_name=None,
+                           load_profile=None):
+    update_name = u"{}.{}".format(cls.__name__, method_name)
+
+    if queue_name is None:
+        current_job = get_current_job()
+        queue_name = current_job.origin if current_job else ti_queues[0].name
+
+    succeeded_ids = [obj_id for obj_id in obj_id_list if obj_id not in failures]
+
+    try:
+        pipe = redis_rq_conn.pipeline()
+        if succeeded_ids:
+            pipe.hdel(retry_counts_key(update_name), *succeeded_ids)
+        for obj_id in failures:
+            pipe.hincrby(retry_counts_key(update_name), obj_id, 1)
+        attempts = pipe.execute()[-len(failures):] if failures else []
+
+        pipe = redis_rq_conn.pipeline()
+        for (obj_id, num_attempts) in zip(failures.keys(), attempts):
+            if num_attempts > update_max_retries:
+                print u"{} failed {} times on {}, giving up on it".format(obj_id, num_attempts, update_name)
+                pipe.hset(dead_letter_key(update_name), obj_id, json.dumps({
+                    "attempts": num_attempts,
+                    "failed_at": time(),
+                    "exception": failures[obj_id]
+                }))
+                pipe.hdel(retry_counts_key(update_name), obj_id)
+            else:
+                backoff = update_retry_backoff_seconds * (2 ** (num_attempts - 1))
+                backoff *= random.uniform(1, 1.25)  # so they don't all come back at once
+                print u"{} failed on {}, retrying in {}sec".format(obj_id, update_name, int(backoff))
+                retry = json.dumps({
+                    "cls": u"{}.{}".format(cls.__module__, cls.__name__),
+                    "method": method_name,
+                    "id": obj_id,
+                    "queue": queue_name,
+                    "load_columns": load_columns,
+                    "load_profile": load_profile,
+                    "high_priority": high_priority
+                }, sort_keys=True)
+                pipe.zadd(update_retries_key, retry, time() + backoff)
+        pipe.execute()
+    except redis.RedisError:
+        logging.exception(u"couldn't schedule retries for {}".format(update_name))
+
+
+def promote_due_retries(max_to_promote=500):
+    """
+    Enqueues a single-id update_fn job for every retry that's due.
+    Called at the end of every rq job, or as  python jobs.py promote_due_retries
+    """
+    due = redis_rq_conn.zrangebyscore(update_retries_key, "-inf", time(), start=0, num=max_to_promote)
+    if not due:
+        return 0
+
+    # whoever removes a retry gets to enqueue it, so two workers can't both do it
+    pipe = redis_rq_conn.pipeline()
+    for retry in due:
+        pipe.zrem(update_retries_key, retry)
+    removed = pipe.execute()
+
+    batches = {}
+    for (retry_json, was_removed) in zip(due, removed):
+        if not was_removed:
+            continue
+        retry = json.loads(retry_json)
+        (module_name, cls_name) = retry["cls"].rsplit(".", 1)
+        cls = getattr(importlib.import_module(module_name), cls_name)
+
+        if not acquire_leases(u"{}.{}".format(cls_name, retry["method"]), [retry["id"]]):
+            # already queued or running for some other reason, so that'll do
+            continue
+
+        kwargs = {"load_columns": retry["load_columns"], "load_profile": retry.get("load_profile", None)}
+        if retry["high_priority"]:
+            kwargs["high_priority"] = True
+        batch_key = (retry["queue"], json.dumps(kwargs, sort_keys=True))
+        batches.setdefault(batch_key, []).append([cls, retry["method"], [retry["id"]]])
+
+    num_promoted = 0
+    for ((queue_name, kwargs_json), update_fn_args_list) in batches.iteritems():
+        queue = Queue(queue_name, connection=redis_rq_conn)
+        num_promoted += enqueue_update_fn_batch(queue, update_fn_args_list, json.loads(kwargs_json))
+
+    print u"enqueued {} retries".format(num_promoted)
+    return num_promoted
+
+
+def dead_letters(update_name):
+    # python jobs.py dead_letters Person.refresh
+    for (obj_id, dead_letter_json) in redis_rq_conn.hgetall(dead_letter_key(update_name)).iteritems():
+        dead_letter = json.loads(dead_letter_json)
+        print u"{}: failed {} times, last at {}\n{}\n".format(
+            obj_id, dead_letter["attempts"], dead_letter["failed_at"], dead_letter["exception"])
+
+
+def retry_dead_letters(update_name):
+    # python jobs.py retry_dead_letters Person.refresh
+    # once whatever broke them is fixed, gives them all another full set of retries
+    obj_ids = redis_rq_conn.hkeys(dead_letter_key(update_name))
+    if not obj_ids:
+        print u"no dead letters for {}".format(update_name)
+        return
+
+    import jobs_defs
+    update = update_registry.get(update_name)
+    leased_ids = acquire_leases(update_name, obj_ids)
+    enqueue_routed_batch(
+        [(update.get_queue(obj_id), [update.cls, update.method.__name__, [obj_id]]) for obj_id in leased_ids],
+        {"load_columns": update.load_columns, "load_profile": update.load_profile}
+    )
+    # the ones already in flight keep their dead letters, so a later retry still has them
+    if leased_ids:
+        redis_rq_conn.hdel(dead_letter_key(update_name), *leased_ids)
+    print u"enqueued {} dead letters from {}".format(len(leased_ids), update_name)
+    if len(leased_ids) < len(obj_ids):
+        print u"{} of them were already queued or running, so they're still dead letters".format(
+            len(obj_ids) - len(leased_ids))
+
+
+
+# how many jobs we write to redis in each pipelined transaction
+enqueue_batch_size = 500
+
+# running without rq, enqueue_jobs can spread the chunks over a pool of local processes.
+# the children are forked after the shortcut data is made, so they all share it.
+_pool_shortcut_data = None
+
+def init_pool_process(shortcut_data):
+    global _pool_shortcut_data
+    _pool_shortcut_data = shortcut_data
+
+    # don't share the parent's db connections.  update_fn would notice the new pid anyway.
+    reset_db_after_fork()
+
+
+def pool_update_fn(cls, method_name, obj_id_list, index, run_chunk, update_fn_kwargs):
+    update_fn(cls, method_name, obj_id_list, _pool_shortcut_data, index=index, run_chunk=run_chunk, **update_fn_kwargs)
+
+
+
+# a feeder (enqueue_jobs with a feed_depth) waits for room on the queues before each batch,
+# and remembers the last id it enqueued for each update
+feeder_poll_seconds = 2
+
+def feeder_cursor_key(update_name):
+    return u"feeder-cursor:{}".format(update_name)
+
+def get_feeder_cursor(update_name):
+    return redis_rq_conn.get(feeder_cursor_key(update_name))
+
+def set_feeder_cursor(update_name, last_id):
+    redis_rq_conn.set(feeder_cursor_key(update_name), last_id)
+
+def clear_feeder_cursor(update_name):
+    redis_rq_conn.delete(feeder_cursor_key(update_name))
+
+
+def wait_for_queue_room(queues, depth):
+    while any([queue.count >= depth for queue in queues]):
+        sleep(feeder_poll_seconds)
+
+
+def get_queue_for_id(obj_id):
+    # the same id always goes to the same queue, until RQ_NUM_QUEUES changes
+    return ti_queues[ti_queue_ring.get_node(obj_id)]
+
+
+def enqueue_run_batch(queues_and_args, update_fn_kwargs=None, run_name=None):
+    # like enqueue_routed_batch, but in a named run the chunks are numbered,
+    # so the workers can mark them done
+    per_job_kwargs_list = None
+    if run_name:
+        chunk_indexes = add_run_chunks(run_name, [update_fn_args[2] for (queue, update_fn_args) in queues_and_args])
+        per_job_kwargs_list = [{"run_chunk": [run_name, chunk_index]} for chunk_index in chunk_indexes]
+    return enqueue_routed_batch(queues_and_args, update_fn_kwargs, per_job_kwargs_list)
+
+
+def enqueue_routed_batch(queues_and_args, update_fn_kwargs=None, per_job_kwargs_list=None):
+    # takes [(queue, update_fn_args), ...] and enqueues them, one pipeline per queue
+    args_by_queue_name = {}
+    job_kwargs_by_queue_name = {}
+    queues_by_name = {}
+    for (i, (queue, update_fn_args)) in enumerate(queues_and_args):
+        args_by_queue_name.setdefault(queue.name, []).append(update_fn_args)
+        job_kwargs_by_queue_name.setdefault(queue.name, []).append(per_job_kwargs_list[i] if per_job_kwargs_list else {})
+        queues_by_name[queue.name] = queue
+
+    num_enqueued = 0
+    for (queue_name, update_fn_args_list) in args_by_queue_name.iteritems():
+        num_enqueued += enqueue_update_fn_batch(
+            queues_by_name[queue_name],
+            update_fn_args_list,
+            update_fn_kwargs,
+            job_kwargs_by_queue_name[queue_name]
         )
+    return num_enqueued
 
-    commit_success = safe_commit(db)
-    if not commit_success:
-        print u"COMMIT fail"
-    db.session.remove()  # close connection nicely
-    return None  # important for if we use this on RQ
+def enqueue_update_fn_batch(queue, update_fn_args_list, update_fn_kwargs=None, per_job_kwargs_list=None):
+    """
+    Builds an update_fn job for each args list in memory, meta and all,
+    then writes them all to the queue in one pipelined redis transaction.
+    per_job_kwargs_list, if given, has extra kwargs for each job.
+    """
+    pipe = queue.connection.pipeline()
+    pipe.sadd(queue.redis_queues_keys, queue.key)
+
+    for (i, update_fn_args) in enumerate(update_fn_args_list):
+        job_kwargs = dict(update_fn_kwargs or {})
+        if per_job_kwargs_list:
+            job_kwargs.update(per_job_kwargs_list[i])
+
+        job = Job.create(
+            func=update_fn,
+            args=update_fn_args,
+            kwargs=job_kwargs,
+            connection=queue.connection,
+            timeout=60 * 10,
+            result_ttl=0,  # number of seconds
+            status=JobStatus.QUEUED,
+            origin=queue.name
+        )
+        job.meta["object_ids_chunk"] = update_fn_args[2]
+        job.enqueued_at = utcnow()
+        job.save(pipeline=pipe)
+        queue.push_job_id(job.id, pipeline=pipe)
+
+    pipe.execute()
+    return len(update_fn_args_list)
+
+
+def stream_ids(ids_query, id_column, num_ids=None, min_id=None, page_size=1000):
+    """
+    Yields the ids from an id query, in id order, a page at a time.
+
+    Uses keyset pagination (id > last id seen) rather than offsets, so every page
+    is an index range scan, and nothing is sorted or held beyond one page.
+    Each page is fetched whole before its ids are handed out, so whatever
+    we do with them (update_fn may swap the engine's pool) can't break the paging.
+    """
+    last_id = min_id
+    num_yielded = 0
+
+    while True:
+        this_page_size = page_size
+        if num_ids is not None:
+            this_page_size = min(page_size, num_ids - num_yielded)
+        if this_page_size <= 0:
+            return
+
+        page_q = ids_query.order_by(None).order_by(id_column)
+        if last_id is not None:
+            page_q = page_q.filter(id_column > last_id)
+        rows = page_q.limit(this_page_size).all()
+        if not rows:
+            return
 
+        for row in rows:
+            yield row[0]
+        num_yielded += len(rows)
+        last_id = rows[-1][0]
+
+        if len(rows) < this_page_size:
+            return
 
 
 def enqueue_jobs(cls,
@@ -87,16 +572,50 @@ def enqueue_jobs(cls,
          ids_q_or_list,
          queue_number,
          use_rq=True,
-         chunk_size=25,
-         shortcut_fn=None
+         chunk_size=None,
+         shortcut_fn=None,
+         load_columns=None,
+         num_jobs=None,
+         min_id=None,
+         high_priority=False,
+         feed_depth=None,
+         run_name=None,
+         resume=False,
+         processes=None,
+         load_profile=None
     ):
     """
     Takes sqlalchemy query with IDs, runs fn on those repos.
+    Ids from a query are streamed in id order, starting after min_id and
+    stopping after num_jobs, so the first jobs go out as soon as the first page is in.
+    With no chunk_size, chunks are sized from how long this job has been taking per object.
+    high_priority jobs go on the high priority queue, which every worker checks first,
+    and make their provider calls in the high priority lane.
+    Ids already in flight for this update (queued or running, from any run) are skipped.
+    With no queue_number, each id goes to the queue its id hashes to, see get_queue_for_id.
+    With a feed_depth, this becomes a feeder: it keeps each queue at about that many
+    jobs, topping them up as the workers drain them, and keeps a cursor in redis so a
+    restarted feeder picks up where it left off.
+    With a run_name, the run's progress is kept in redis (see update_runs.py), and
+    resume=True carries on from there: unfinished chunks that aren't still queued
+    or running are redone, then it continues after the high water mark.
+    Without rq, processes > 1 runs the chunks in that many local processes at once.
+    A load_profile (see models/load_profiles.py) says what each job loads with its objects.
     """
 
+    update_fn_kwargs = {"load_columns": load_columns, "load_profile": load_profile}
+    if high_priority:
+        update_fn_kwargs["high_priority"] = True
+
+    def get_queue(obj_id):
+        if high_priority:
+            return ti_high_priority_queue
+        if queue_number is not None:
+            return ti_queues[queue_number]
+        return get_queue_for_id(obj_id)
+
     shortcut_data = None
     if use_rq:
-        empty_queue(queue_number)
         if shortcut_fn:
             raise ValueError("you can't use RQ with a shortcut_fn")
 
@@ -109,6 +628,12 @@ def enqueue_jobs(cls,
                 elapsed(shortcut_data_start)
             )
 
+    update_name = u"{}.{}".format(cls.__name__, method)
+    adaptive_chunk_size = not chunk_size
+    if adaptive_chunk_size:
+        chunk_size = get_adaptive_chunk_size(update_name, default_chunk_size=10)
+        print u"sizing chunks for about {}sec each: starting with {} per chunk".format(
+            target_chunk_seconds, chunk_size)
     chunk_size = int(chunk_size)
 
 
@@ -116,68 +641,221 @@ def enqueue_jobs(cls,
     new_loop_start_time = time()
     index = 0
 
-    print "running this query: \n{}\n".format(
-        ids_q_or_list.statement.compile(dialect=postgresql.dialect())
-    )
-    row_list = ids_q_or_list.all()
-    print "finished query in {}sec".format(elapsed(start_time))
-    if row_list is None:
-        print "no IDs, all done."
-        return None
+    if isinstance(ids_q_or_list, list):
+        run_name = None  # nothing to resume
+    feeding = use_rq and feed_depth and not isinstance(ids_q_or_list, list)
+
+    leftover_ids = []
+    if run_name and resume:
+        run = get_run(run_name)
+        if not run:
+            raise ValueError(u"there's no run called {} to resume".format(run_name))
+        if run["update"] != update_name:
+            raise ValueError(u"run {} is a {} run, not {}".format(run_name, run["update"], update_name))
+        if min_id is None:
+            min_id = run["high_water"]
+
+        # retire the unfinished chunks.  their ids that aren't still queued or running
+        # (the leases sort that out) go out again first, in new chunks.
+        unfinished_chunks = get_unfinished_run_chunks(run_name)
+        mark_run_chunks_done(run_name, unfinished_chunks.keys())
+        for chunk_index in sorted(unfinished_chunks.keys()):
+            leftover_ids += unfinished_chunks[chunk_index]
+        if not use_rq:
+            # nothing else runs our chunks, so their leases died with the process that had them
+            release_leases(update_name, leftover_ids)
+        print u"resuming run {} after id {}, with {} ids from {} unfinished chunks".format(
+            run_name, min_id, len(leftover_ids), len(unfinished_chunks))
+    elif run_name:
+        start_run(run_name, update_name)
+        print u"starting run {}.  if it stops, carry on with  --resume {}".format(run_name, run_name)
+    elif feeding and min_id is None:
+        min_id = get_feeder_cursor(update_name)
+        if min_id:
+            print u"resuming the feeder after id {}".format(min_id)
 
-    object_ids = [row[0] for row in row_list]
+    if isinstance(ids_q_or_list, list):
+        object_ids = ids_q_or_list
+        num_jobs = len(object_ids)
+    else:
+        print "streaming ids from this query: \n{}\n".format(
+            ids_q_or_list.statement.compile(dialect=postgresql.dialect())
+        )
+        object_ids = stream_ids(ids_q_or_list, cls.id, num_ids=num_jobs, min_id=min_id)
+    object_ids = chain(leftover_ids, object_ids)
 
-    num_jobs = len(object_ids)
     if use_rq:
-        print "adding {} jobs to queue...".format(num_jobs)
+        print "adding up to {} jobs to queue...".format(num_jobs)
 
     # iterate through chunks of IDs like [[id1, id2], [id3, id4], ...  ]
-    object_ids_chunk = []
-
-
-    for object_ids_chunk in chunks(object_ids, chunk_size):
-
-        update_fn_args = [cls, method, object_ids_chunk]
-
-        if use_rq:
-            job = ti_queues[queue_number].enqueue_call(
-                func=update_fn,
-                args=update_fn_args,
-                timeout=60 * 10,
-                result_ttl=0  # number of seconds
-            )
-            job.meta["object_ids_chunk"] = object_ids_chunk
-            job.save()
+    object_ids_iter = iter(object_ids)
+    last_object_ids_chunk = []
+    num_ids_done = 0
+    num_ids_in_flight = 0
+    num_rq_jobs = 0
+    last_id_taken = None
+    rq_batch = []
+    # with a cursor or high water mark to keep, everything up to it has to really be enqueued
+    checkpointing = use_rq and (feeding or run_name)
+    if feeding:
+        # small batches, so we never get far ahead of the workers
+        rq_batch_size = max(1, min(enqueue_batch_size, feed_depth * len(ti_queues) / 2))
+    else:
+        rq_batch_size = enqueue_batch_size
+    routed_ids = {}  # queue name: ids headed there that aren't a full chunk yet
+    num_ids_queued_ahead = 0  # roughly, from the jobs already waiting when we started
+    queue_seconds_per_object = 0
+    if use_rq:
+        num_ids_queued_ahead = sum([queue.count for queue in ti_queues + [ti_high_priority_queue]]) * chunk_size
+        queue_seconds_per_object = get_queue_seconds_per_object(update_name)
+
+    pool = None
+    pool_results = []
+    if not use_rq and processes > 1:
+        print u"running chunks in {} processes".format(processes)
+        db.session.remove()  # so the children don't inherit our connection
+        pool = multiprocessing.Pool(processes, initializer=init_pool_process, initargs=(shortcut_data,))
+
+
+    # the children have to be cleaned up however we leave the loop, or they're left running
+    try:
+        while True:
+            if adaptive_chunk_size and index and index % 100 == 0:
+                # workers have been reporting timings since we started, so take another look
+                chunk_size = get_adaptive_chunk_size(update_name, default_chunk_size=chunk_size)
+
+            # fill the chunk with ids that aren't already in flight
+            object_ids_chunk = []
+            while len(object_ids_chunk) < chunk_size:
+                candidate_ids = list(islice(object_ids_iter, chunk_size - len(object_ids_chunk)))
+                if not candidate_ids:
+                    break
+                num_ids_done += len(candidate_ids)
+                if num_ids_done > len(leftover_ids):
+                    last_id_taken = candidate_ids[-1]  # from the stream, not a leftover
+                # a queued lease has to last until its job starts (update_fn takes over from there),
+                # so with a lot queued ahead, it's twice how long the workers should take to get to it
+                lease_seconds = max(queued_lease_seconds,
+                                    int(2 * (num_ids_queued_ahead + num_ids_done) * queue_seconds_per_object))
+                leased_ids = acquire_leases(update_name, candidate_ids, lease_seconds)
+                num_ids_in_flight += len(candidate_ids) - len(leased_ids)
+                object_ids_chunk += leased_ids
+
+            if not object_ids_chunk:
+                break
+            last_object_ids_chunk = object_ids_chunk
+
+            update_fn_args = [cls, method, object_ids_chunk]
+
+            if use_rq:
+                for obj_id in object_ids_chunk:
+                    queue = get_queue(obj_id)
+                    routed_ids.setdefault(queue.name, []).append(obj_id)
+                    if len(routed_ids[queue.name]) >= chunk_size:
+                        rq_batch.append((queue, [cls, method, routed_ids.pop(queue.name)]))
+                if len(rq_batch) >= rq_batch_size:
+                    if checkpointing:
+                        # send the partial chunks too, so everything up to the cursor is enqueued
+                        for (queue_name, obj_ids) in routed_ids.iteritems():
+                            rq_batch.append((get_queue(obj_ids[0]), [cls, method, obj_ids]))
+                        routed_ids = {}
+                    if feeding:
+                        wait_for_queue_room([queue for (queue, update_fn_args) in rq_batch], feed_depth)
+                    num_rq_jobs += enqueue_run_batch(rq_batch, update_fn_kwargs, run_name)
+                    rq_batch = []
+                    if feeding and last_id_taken and not run_name:
+                        set_feeder_cursor(update_name, last_id_taken)
+                    if run_name and last_id_taken:
+                        set_run_high_water(run_name, last_id_taken)
+            elif pool:
+                run_chunk = None
+                if run_name:
+                    run_chunk = [run_name, add_run_chunks(run_name, [object_ids_chunk])[0]]
+                pool_results.append(pool.apply_async(
+                    pool_update_fn,
+                    (cls, method, object_ids_chunk, index, run_chunk, update_fn_kwargs)
+                ))
+                # chunks finish out of order, but the done bitmap covers any that don't
+                if run_name and last_id_taken:
+                    set_run_high_water(run_name, last_id_taken)
+
+                # don't get more than a couple of chunks ahead of the children.  get() passes on their exceptions.
+                while len(pool_results) > processes * 2:
+                    pool_results.pop(0).get()
+            else:
+                print "not using rq"
+                update_fn_args.append(shortcut_data)
+                run_chunk = None
+                if run_name:
+                    run_chunk = [run_name, add_run_chunks(run_name, [object_ids_chunk])[0]]
+                update_fn(*update_fn_args, index=index, run_chunk=run_chunk, **update_fn_kwargs)
+                if run_name and last_id_taken:
+                    set_run_high_water(run_name, last_id_taken)
+
+            # with rq, this would only measure how fast we enqueue.  the workers record
+            # how fast the jobs really go:  python jobs.py job_stats
+            if not use_rq:
+                num_jobs_remaining = num_jobs - num_ids_done
+                try:
+                    jobs_per_hour_this_chunk = chunk_size / float(elapsed(new_loop_start_time) / 3600)
+                    predicted_mins_to_finish = round(
+                        (num_jobs_remaining / float(jobs_per_hour_this_chunk)) * 60,
+                        1
+                    )
+                    print "\n\nWe're doing {} jobs per hour. At this rate, done in {}min".format(
+                        int(jobs_per_hour_this_chunk),
+                        predicted_mins_to_finish
+                    )
+                    print "(finished chunk {} of at most {} chunks in {}sec total, {}sec this loop)\n".format(
+                        index,
+                        index + num_jobs_remaining/chunk_size,
+                        elapsed(start_time),
+                        elapsed(new_loop_start_time)
+                    )
+                except ZeroDivisionError:
+                    print ".",
+
+
+                new_loop_start_time = time()
+            index += 1
+
+        if pool:
+            for pool_result in pool_results:
+                pool_result.get()
+            pool.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    for (queue_name, obj_ids) in routed_ids.iteritems():
+        rq_batch.append((get_queue(obj_ids[0]), [cls, method, obj_ids]))
+    if rq_batch:
+        if feeding:
+            wait_for_queue_room([queue for (queue, update_fn_args) in rq_batch], feed_depth)
+        num_rq_jobs += enqueue_run_batch(rq_batch, update_fn_kwargs, run_name)
+    if run_name and last_id_taken:
+        set_run_high_water(run_name, last_id_taken)
+
+    if feeding and not run_name:
+        if num_ids_done < num_jobs:
+            # ran out of ids, so the next feeder starts from the beginning
+            clear_feeder_cursor(update_name)
         else:
-            print "not using rq"
-            update_fn_args.append(shortcut_data)
-            update_fn(*update_fn_args, index=index)
+            set_feeder_cursor(update_name, last_id_taken)
+            print u"stopped at the limit; the next feeder run continues after id {}".format(last_id_taken)
 
-        if True: # index % 10 == 0 and index != 0:
-            num_jobs_remaining = num_jobs - (index * chunk_size)
-            try:
-                jobs_per_hour_this_chunk = chunk_size / float(elapsed(new_loop_start_time) / 3600)
-                predicted_mins_to_finish = round(
-                    (num_jobs_remaining / float(jobs_per_hour_this_chunk)) * 60,
-                    1
-                )
-                print "\n\nWe're doing {} jobs per hour. At this rate, done in {}min".format(
-                    int(jobs_per_hour_this_chunk),
-                    predicted_mins_to_finish
-                )
-                print "(finished chunk {} of {} chunks in {}sec total, {}sec this loop)\n".format(
-                    index,
-                    num_jobs/chunk_size,
-                    elapsed(start_time),
-                    elapsed(new_loop_start_time)
-                )
-            except ZeroDivisionError:
-                print ".",
+    if num_ids_in_flight:
+        print "skipped {} ids that were already queued or running".format(num_ids_in_flight)
 
+    if use_rq:
+        print "enqueued {} ids in {} jobs in {}sec. watch them with  python jobs.py job_stats".format(
+            num_ids_done - num_ids_in_flight, num_rq_jobs, elapsed(start_time))
 
-            new_loop_start_time = time()
-        index += 1
-    print "last chunk of ids: {}".format(list(object_ids_chunk))
+    if not last_object_ids_chunk:
+        print "no IDs, all done."
+        return None
+    print "last chunk of ids: {}".format(list(last_object_ids_chunk))
 
     db.session.remove()  # close connection nicely
     return True
@@ -201,125 +879,157 @@ update_registry = UpdateRegistry()
 
 
 class Update():
-    def __init__(self, job, query, queue_id=None, chunk_size_default=10, shortcut_fn=None):
+    def __init__(self, job, query, queue_id=None, chunk_size_default=None, shortcut_fn=None, load_columns=None,
+                 load_profile=None):
 
-        self.queue_id = queue_id
+        self.queue_id = queue_id  # None spreads the jobs over all the queues
         self.job = job
         self.method = job
         self.cls = job.im_class
-        self.chunk_size_default = chunk_size_default
+        self.chunk_size_default = chunk_size_default  # None means size chunks from observed timings
         self.shortcut_fn = shortcut_fn
+        self.load_columns = load_columns  # default is to load every column
+        self.load_profile = load_profile  # named load profile, see models/load_profiles.py.  wins over load_columns
 
         self.name = "{}.{}".format(self.cls.__name__, self.method.__name__)
         self.query = query.order_by(self.cls.id)
 
-    def run(self, use_rq=False, obj_id=None, num_jobs=None, chunk_size=None, min_id=None):
+    def get_queue(self, obj_id):
+        # the same queue enqueue_jobs would send this id to
+        if self.queue_id is not None:
+            return ti_queues[self.queue_id]
+        return get_queue_for_id(obj_id)
+
+    def run(self, use_rq=False, obj_id=None, num_jobs=None, chunk_size=None, min_id=None, high_priority=False,
+            feed_depth=None, run_name=None, resume=False, processes=None):
 
         if num_jobs is None:
             num_jobs = 1000
 
-        if use_rq:
-            if self.queue_id is None:
-                raise ValueError("you need a queue number to use RQ")
-
         if chunk_size is None:
             chunk_size = self.chunk_size_default
 
-        query = self.query
-        if min_id:
-            query = query.filter(self.cls.id > min_id)
-
         if obj_id:
-            # don't run the query, just get the id that was requested
-            query = db.session.query(self.cls.id).filter(self.cls.id == obj_id)
+            # don't run the query, just use the id that was requested
+            ids_q_or_list = [obj_id]
         else:
-            query = query.limit(num_jobs)
+            ids_q_or_list = self.query
 
         enqueue_jobs(
             self.cls,
             self.method.__name__,
-            query,
+            ids_q_or_list,
             self.queue_id,
             use_rq,
             chunk_size,
-            self.shortcut_fn
+            self.shortcut_fn,
+            self.load_columns,
+            num_jobs=num_jobs,
+            min_id=min_id,
+            high_priority=high_priority,
+            feed_depth=feed_depth,
+            run_name=run_name,
+            resume=resume,
+            processes=processes,
+            load_profile=self.load_profile
         )
 
 
 
 
 class UpdateStatus():
-    seconds_between_chunks = 15
+    seconds_between_prints = 15
 
-    def __init__(self, num_jobs, queue_number):
+    def __init__(self, num_jobs, queue_number=None):
         self.num_jobs_total = num_jobs
-        self.queue_number = queue_number
+        self.queue_number = queue_number  # None watches all the queues
         self.start_time = time()
 
-        self.last_chunk_start_time = time()
-        self.last_chunk_num_jobs_completed = 0
-        self.number_of_prints = 0
-
+        if queue_number is None:
+            self.queues = ti_queues
+        else:
+            self.queues = [ti_queues[queue_number]]
 
 
     def print_status_loop(self):
         num_jobs_remaining = self.print_status()
         while num_jobs_remaining > 0:
+            sleep(self.seconds_between_prints)
             num_jobs_remaining = self.print_status()
 
 
     def print_status(self):
-        sleep(1)  # at top to make sure there's time for the jobs to be saved in redis.
-
-        num_jobs_remaining = ti_queues[self.queue_number].count
+        # throughput and latency come from what the workers record, see job_metrics.py
+        num_jobs_remaining = sum([queue.count for queue in self.queues])
         num_jobs_done = self.num_jobs_total - num_jobs_remaining
 
-
         print "finished {done} jobs in {elapsed} min. {left} left.".format(
             done=num_jobs_done,
             elapsed=round(elapsed(self.start_time) / 60, 1),
             left=num_jobs_remaining
         )
-        self.number_of_prints += 1
 
+        metrics = get_job_metrics(minutes=5)
+        for (update_name, update_metrics) in sorted(metrics["updates"].iteritems()):
+            if not update_metrics["jobs"]:
+                continue
+            print "  {}: {} jobs/hour, {} objects/hour, {} failures, p50 {}sec p90 {}sec per job".format(
+                update_name,
+                update_metrics["jobs_per_hour"],
+                update_metrics["objects_per_hour"],
+                update_metrics["failures"],
+                update_metrics["seconds_per_job"].get("p50"),
+                update_metrics["seconds_per_job"].get("p90")
+            )
 
-        if self.number_of_prints % self.seconds_between_chunks == self.seconds_between_chunks - 1:
+        mins_to_finish = [metrics["queues"][queue.name].get("mins_to_finish", 0) for queue in self.queues]
+        if max(mins_to_finish):
+            print "At this rate, done in {}min\n".format(max(mins_to_finish))
 
-            num_jobs_finished_this_chunk = num_jobs_done - self.last_chunk_num_jobs_completed
-            if not num_jobs_finished_this_chunk:
-                print "No jobs finished this chunk... :/"
+        return num_jobs_remaining
 
-            else:
-                chunk_elapsed = elapsed(self.last_chunk_start_time)
 
-                jobs_per_hour_this_chunk = num_jobs_finished_this_chunk / float(chunk_elapsed / 3600)
-                predicted_mins_to_finish = round(
-                    (num_jobs_remaining / float(jobs_per_hour_this_chunk)) * 60,
-                    1
-                )
-                print "We're doing {} jobs per hour. At this rate, done in {}min\n".format(
-                    int(jobs_per_hour_this_chunk),
-                    predicted_mins_to_finish
-                )
 
-                self.last_chunk_start_time = time()
-                self.last_chunk_num_jobs_completed = num_jobs_done
 
-        return num_jobs_remaining
+def queue_status(queue_number_str=None):
+    # python jobs.py queue_status     or, for just one queue,   python jobs.py queue_status 0
+    queue_number = None if queue_number_str is None else int(queue_number_str)
+    update = UpdateStatus(0, queue_number)
+    update.num_jobs_total = sum([queue.count for queue in update.queues])
+    update.print_status_loop()
 
 
+def job_stats(minutes_str="60", update_name=None):
+    # python jobs.py job_stats 60 Person.refresh
+    print json.dumps(get_job_metrics(minutes=int(minutes_str), update_name=update_name), sort_keys=True, indent=4)
 
 
-def queue_status(queue_number_str):
-    queue_number = int(queue_number_str)
-    num_jobs_to_start = ti_queues[queue_number].count
-    update = UpdateStatus(num_jobs_to_start, queue_number)
-    update.print_status_loop()
+def release_queued_leases(queue):
+    # the ids in the update_fn jobs waiting on this queue aren't in flight anymore once
+    # it's emptied, so later runs shouldn't skip them
+    page_size = 1000
+    offset = 0
+    while True:
+        job_ids = queue.get_job_ids(offset, page_size)
+        if not job_ids:
+            return
+        for job_id in job_ids:
+            job = queue.fetch_job(job_id)
+            try:
+                if not job or job.func_name != "jobs.update_fn" or not job.meta.get("object_ids_chunk"):
+                    continue
+                (cls, method_name) = job.args[0:2]
+            except Exception:
+                logging.exception(u"couldn't read queued job {}".format(job_id))
+                continue
+            release_leases(u"{}.{}".format(cls.__name__, method_name), job.meta["object_ids_chunk"])
+        offset += page_size
 
 
 def empty_queue(queue_number_str):
     queue_number = int(queue_number_str)
     num_jobs = ti_queues[queue_number].count
+    release_queued_leases(ti_queues[queue_number])
     ti_queues[queue_number].empty()
 
     print "emptied {} jobs on queue #{}....".format(
@@ -333,10 +1043,13 @@ def main(fn, optional_args=None):
 
     # call function by its name in this module, with all args :)
     # http://stackoverflow.com/a/4605/596939
+    # through the imported module, not __main__, so jobs we enqueue point at jobs.update_fn
+    # and jobs_defs registers into the same update_registry we look things up in
+    import jobs
     if optional_args:
-        globals()[fn](*optional_args)
+        getattr(jobs, fn)(*optional_args)
     else:
-        globals()[fn]()
+        getattr(jobs, fn)()
 
     print "total time to run:", elapsed(start)
 
@@ -356,7 +1069,6 @@ if __name__ == "__main__":
     print u"running main.py {function} with these args:{optional_args}\n".format(
         function=function, optional_args=optional_args)
 
-    global logger
     logger = logging.getLogger("ti.jobs.{function}".format(
         function=function))
 
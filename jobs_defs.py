@@ -1,7 +1,6 @@
 from sqlalchemy import text
 from sqlalchemy import orm
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.sql.expression import func
 
 from app import db
 import app
@@ -12,13 +11,14 @@ from models.product import Product
 from models.person import Person
 from models import person
 
+# no order_by(func.random()) here, that sorted the whole table.  ids are random
+# shortuuids, so streaming them in id order already mixes people up, repeatably.
 q = db.session.query(Person.id)
 q = q.filter(Person.orcid_id != None)
-q = q.order_by(func.random())
 update_registry.register(Update(
     job=Person.refresh,
     query=q,
-    queue_id=0
+    load_profile="refresh"
 ))
 
 q = db.session.query(Person.id)
@@ -26,6 +26,7 @@ q = q.filter(Person.claimed_at != None)
 update_registry.register(Update(
     job=Person.email_new_stuff,
     query=q,
+    load_profile="api-view"
 ))
 
 
@@ -33,12 +34,14 @@ q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.calculate,
     query=q,
+    load_profile="refresh"
 ))
 
 q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.call_oadoi,
-    query=q
+    query=q,
+    load_profile="refresh"
 ))
 
 
@@ -46,31 +49,35 @@ q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.call_oadoi_on_everything,
     query=q,
-    queue_id=0
+    load_profile="refresh"
 ))
 
 q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.set_from_orcid,
-    query=q
+    query=q,
+    load_profile="refresh"
 ))
 
 q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.set_fulltext_urls,
-    query=q
+    query=q,
+    load_profile="refresh"
 ))
 
 q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.set_mendeley,
-    query=q
+    query=q,
+    load_profile="refresh"
 ))
 
 q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.set_mendeley_sums,
-    query=q
+    query=q,
+    load_profile="api-view"
 ))
 
 q = db.session.query(Product.id)
@@ -79,7 +86,8 @@ q = q.filter(Product.altmetric_api_raw != {})
 q = q.filter(Product.event_dates == None)
 update_registry.register(Update(
     job=Product.set_event_dates,
-    query=q
+    query=q,
+    load_columns=["altmetric_api_raw"]
 ))
 
 q = db.session.query(Product.id)
@@ -87,14 +95,16 @@ q = q.filter(Product.altmetric_api_raw != None)
 q = q.filter(Product.altmetric_score == None)
 update_registry.register(Update(
     job=Product.set_altmetric_score,
-    query=q
+    query=q,
+    load_columns=["altmetric_api_raw"]
 ))
 
 q = db.session.query(Product.id)
 q = q.filter(Product.altmetric_api_raw != None)
 update_registry.register(Update(
     job=Product.set_altmetric_id,
-    query=q
+    query=q,
+    load_columns=["altmetric_api_raw"]
 ))
 
 q = db.session.query(Product.id)
@@ -102,13 +112,15 @@ q = q.filter(Product.post_counts != None)
 q = q.filter(Product.post_counts != {})
 update_registry.register(Update(
     job=Product.set_post_details,
-    query=q
+    query=q,
+    load_columns=["altmetric_api_raw"]
 ))
 
 q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.set_post_details,
-    query=q
+    query=q,
+    load_profile="refresh"
 ))
 
 # q = db.session.query(Person.id)
@@ -120,14 +132,16 @@ update_registry.register(Update(
 q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.set_coauthors,
-    query=q
+    query=q,
+    load_profile="api-view"
 ))
 
 q = db.session.query(Person.id)
 q = q.filter(Person.twitter != None)
 update_registry.register(Update(
     job=Person.update_twitter_profile_data,
-    query=q
+    query=q,
+    load_profile="auth"
 ))
 
 
@@ -135,13 +149,15 @@ update_registry.register(Update(
 q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.run_log_openness,
-    query=q
+    query=q,
+    load_profile="api-view"
 ))
 
 q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.set_num_oa_licenses,
-    query=q
+    query=q,
+    load_profile="api-view"
 ))
 
 
@@ -155,26 +171,30 @@ q = db.session.query(Person.id)
 #             "0000-0001-6728-7745"]))
 update_registry.register(Update(
     job=Person.set_badge_percentiles,
-    query=q
+    query=q,
+    load_profile="api-view"
 ))
 
 q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.assign_badges,
     query=q,
-    shortcut_fn=lambda: ["open_license", "percent_fulltext", "all_fulltext"]
+    shortcut_fn=lambda: ["open_license", "percent_fulltext", "all_fulltext"],
+    load_profile="badges"
 ))
 
 q = db.session.query(Person.id)
 # q = q.filter(Person.updated < '2016-04-10 10:00:51.972209')
 update_registry.register(Update(
     job=Person.refresh_from_db,
-    query=q
+    query=q,
+    load_profile="refresh"
 ))
 
 q = db.session.query(Person.id)
 update_registry.register(Update(
     job=Person.all_products_set_biblio_from_orcid,
-    query=q
+    query=q,
+    load_profile="refresh"
 ))
 
@@ -0,0 +1,80 @@
+import os
+import logging
+import redis
+from contextlib import contextmanager
+
+from app import redis_rq_conn
+
+
+# an id is in flight for an update from when it's enqueued until its job finishes.
+# while it is, nobody else enqueues it (or refreshes it from the web) for that update.
+# leases expire in case the job never finishes, so nothing is stuck forever.
+queued_lease_seconds = int(os.getenv("UPDATE_QUEUED_LEASE_SECONDS", 60 * 60 * 6))
+running_lease_seconds = int(os.getenv("UPDATE_RUNNING_LEASE_SECONDS", 60 * 15))
+
+
+def lease_key(update_name, obj_id):
+    return u"inflight:{}:{}".format(update_name, obj_id)
+
+
+def acquire_leases(update_name, obj_ids, seconds=queued_lease_seconds):
+    # returns the ids we got leases for, in order; the rest are already in flight
+    if not obj_ids:
+        return []
+    try:
+        pipe = redis_rq_conn.pipeline()
+        for obj_id in obj_ids:
+            pipe.set(lease_key(update_name, obj_id), 1, ex=seconds, nx=True)
+        acquired = pipe.execute()
+    except redis.RedisError:
+        # better to maybe do something twice than not at all
+        logging.exception(u"couldn't get leases for {}".format(update_name))
+        return list(obj_ids)
+    return [obj_id for (obj_id, got_it) in zip(obj_ids, acquired) if got_it]
+
+
+def extend_leases(update_name, obj_ids, seconds=running_lease_seconds):
+    # whether or not they had one, these ids are being worked on now
+    try:
+        pipe = redis_rq_conn.pipeline()
+        for obj_id in obj_ids:
+            pipe.set(lease_key(update_name, obj_id), 1, ex=seconds)
+        pipe.execute()
+    except redis.RedisError:
+        logging.exception(u"couldn't extend leases for {}".format(update_name))
+
+
+def get_leased_ids(update_name, obj_ids):
+    # the ids that are still in flight, in order
+    if not obj_ids:
+        return []
+    try:
+        pipe = redis_rq_conn.pipeline()
+        for obj_id in obj_ids:
+            pipe.exists(lease_key(update_name, obj_id))
+        leased = pipe.execute()
+    except redis.RedisError:
+        logging.exception(u"couldn't check leases for {}".format(update_name))
+        return list(obj_ids)
+    return [obj_id for (obj_id, is_leased) in zip(obj_ids, leased) if is_leased]
+
+
+def release_leases(update_name, obj_ids):
+    if not obj_ids:
+        return
+    try:
+        redis_rq_conn.delete(*[lease_key(update_name, obj_id) for obj_id in obj_ids])
+    except redis.RedisError:
+        logging.exception(u"couldn't release leases for {}".format(update_name))
+
+
+@contextmanager
+def lease(update_name, obj_id, seconds=running_lease_seconds):
+    # holds a lease for the block if nobody else has one.  yields whether we got it,
+    # so the caller can decide whether to go ahead anyway.
+    got_it = bool(acquire_leases(update_name, [obj_id], seconds))
+    try:
+        yield got_it
+    finally:
+        if got_it:
+            release_leases(update_name, [obj_id])
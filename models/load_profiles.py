@@ -0,0 +1,68 @@
+from sqlalchemy import orm
+
+
+# named loading profiles for Person queries.  a person's products and badges load only
+# when they're touched, and the raw api json columns are deferred, so a plain query
+# gets just the person row.  everywhere that loads people says what else it needs:
+#   auth      just the person row, for logging in, tokens and small edits
+#   api-view  products and badges, everything to_dict shows, but no raw api json
+#   badges    like api-view, plus the products' altmetric json the badge assigners read
+#   refresh   everything, raw api json included, for refreshing and recalculating
+#   refset    just orcid_id, campaign and badges, for the badge percentile refsets
+#
+# "relationships" are loaded with the person, in one more query each, along with the
+# deferred columns listed for them.  "columns" are the person's own deferred columns
+# to load, and "load_only" limits the person's columns to just those.
+load_profiles = {
+    "auth": {
+        "relationships": {},
+        "columns": []
+    },
+    "api-view": {
+        "relationships": {
+            "products": [],
+            "badges": []
+        },
+        "columns": []
+    },
+    "badges": {
+        "relationships": {
+            "products": ["altmetric_api_raw"],
+            "badges": []
+        },
+        "columns": []
+    },
+    "refresh": {
+        "relationships": {
+            "products": ["orcid_api_raw_json", "altmetric_api_raw", "authors"],
+            "badges": []
+        },
+        "columns": ["orcid_api_raw_json"]
+    },
+    "refset": {
+        "relationships": {
+            "badges": []
+        },
+        "columns": [],
+        "load_only": ["campaign", "orcid_id"]
+    }
+}
+
+
+def load_profile_options(profile_name):
+    profile = load_profiles[profile_name]
+
+    options = []
+    if profile.get("load_only"):
+        options.append(orm.load_only(*profile["load_only"]))
+    for column in profile["columns"]:
+        options.append(orm.undefer(column))
+    for (relationship, columns) in profile["relationships"].iteritems():
+        options.append(orm.subqueryload(relationship))
+        for column in columns:
+            options.append(orm.defaultload(relationship).undefer(column))
+    return options
+
+
+def with_load_profile(query, profile_name):
+    return query.options(*load_profile_options(profile_name))
@@ -1,4 +1,7 @@
 from time import time
+from email.utils import formatdate
+import calendar
+import datetime
 import requests
 import re
 import os
@@ -12,6 +15,7 @@ from util import clean_doi
 
 
 from models.bibtex import parse
+from providers import provider_get
 
 class NoOrcidException(Exception):
     pass
@@ -72,18 +76,25 @@ def get_orcid_id_from_oauth(auth_code, redirect_uri):
 
 
 
-def call_orcid_api(url):
+def call_orcid_api(url, cache_id=None, modified_since=None):
     headers = {'Accept': 'application/orcid+json'}
     start = time()
 
+    # returns None if we ask for changes since modified_since and ORCID says there aren't any
+    if modified_since:
+        headers["If-Modified-Since"] = formatdate(calendar.timegm(modified_since.utctimetuple()), usegmt=True)
+
     # might throw requests.Timeout
     try:
-        r = requests.get(url, headers=headers, timeout=10)
+        r = provider_get("orcid", url, cache_id=cache_id, headers=headers)
     except requests.Timeout:
         # do some error printing here, but let problem be handled further up the stack
         print u"requests.Timeout in call_orcid_api for url {}".format(url)
         raise
 
+    if r.status_code == 304:
+        return None
+
     if r.status_code == 404:
         print u"404, ORCID not found"
         raise OrcidDoesNotExist("Not a valid ORCID")
@@ -100,15 +111,15 @@ def call_orcid_api(url):
     return orcid_resp_dict
 
 
-def get_orcid_api_raw_profile(id):
+def get_orcid_api_raw_profile(id, modified_since=None):
     url = "https://pub.orcid.org/v2.1/{id}".format(id=id)
-    orcid_resp_dict = call_orcid_api(url)
+    orcid_resp_dict = call_orcid_api(url, cache_id=id, modified_since=modified_since)
     return orcid_resp_dict
 
 # main constructor
-def make_and_populate_orcid_profile(orcid_id):
+def make_and_populate_orcid_profile(orcid_id, modified_since=None):
     new_profile = OrcidProfile(orcid_id)
-    new_profile.populate_from_orcid()
+    new_profile.populate_from_orcid(modified_since)
     return new_profile
 
 # uses multithreaded approach from http://www.shanelynn.ie/using-python-threading-for-multiple-results-queue/
@@ -293,8 +304,18 @@ class OrcidProfile(object):
         # determines the 
         self.has_name_variant_beyond_search_query = False
 
-    def populate_from_orcid(self):
-        self.api_raw_profile = get_orcid_api_raw_profile(self.id)
+    def populate_from_orcid(self, modified_since=None):
+        self.api_raw_profile = get_orcid_api_raw_profile(self.id, modified_since)
+        # ORCID answered 304: nothing changed since modified_since, so we got no record
+        self.not_modified = (modified_since is not None and self.api_raw_profile is None)
+
+    @property
+    def last_modified(self):
+        try:
+            timestamp = self.api_raw_profile["history"]["last-modified-date"]["value"]
+            return datetime.datetime.utcfromtimestamp(timestamp / 1000.0)
+        except (KeyError, TypeError):
+            return None
 
     @property
     def given_names(self):
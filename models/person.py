@@ -5,6 +5,9 @@ from sqlalchemy.orm import deferred
 from sqlalchemy import orm
 from sqlalchemy import text
 from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy import or_
+from sqlalchemy.orm.attributes import set_committed_value
 
 from app import db
 
@@ -21,9 +24,11 @@ from models.orcid import make_and_populate_orcid_profile
 from models.source import sources_metadata
 from models.source import Source
 from models.refset import Refset
+from models.refset import get_refsets_stamp
 from models.emailer import send
 from models.log_email import save_email
 from models.log_openness import save_openness_log
+from models.load_profiles import with_load_profile
 from util import elapsed
 from util import chunks
 from util import date_as_iso_utc
@@ -31,6 +36,8 @@ from util import days_ago
 from util import safe_commit
 from util import calculate_percentile
 from util import as_proportion
+from util import fingerprint
+from util import json_dumper
 
 from time import time
 from time import sleep
@@ -44,13 +51,20 @@ import re
 import datetime
 import logging
 import operator
-import threading
 import hashlib
 import math
 from nameparser import HumanName
 from collections import defaultdict
 from requests_oauthlib import OAuth1Session
 from util import update_recursive_sum
+from providers import call_method_on_all
+from providers import provider_get
+from providers import priority_lane
+from providers import interactive_refresh_seconds
+from job_metrics import job_stage
+from leases import lease
+from profile_cache import invalidate_cached_profile
+from profile_cache import invalidate_cached_profile_on_commit
 
 
 class PersonExistsException(Exception):
@@ -73,6 +87,8 @@ def get_random_people(n, refset_only=False):
 
 
 def delete_person(orcid_id):
+    twitter_row = db.session.query(Person.twitter).filter_by(orcid_id=orcid_id).first()
+
     # also need delete all the badges, products
     product.Product.query.filter_by(orcid_id=orcid_id).delete()
     badge.Badge.query.filter_by(orcid_id=orcid_id).delete()
@@ -83,10 +99,12 @@ def delete_person(orcid_id):
     commit_success = safe_commit(db)
     if not commit_success:
         print u"COMMIT fail on {}".format(orcid_id)
+    invalidate_cached_profile(orcid_id, twitter_row[0] if twitter_row else None)
 
 def set_person_email(orcid_id, email, high_priority=False):
-    my_person = Person.query.filter_by(orcid_id=orcid_id).first()
+    my_person = with_load_profile(Person.query, "auth").filter_by(orcid_id=orcid_id).first()
     my_person.email = email
+    my_person.invalidate_profile_json()
     db.session.merge(my_person)
     commit_success = safe_commit(db)
     if not commit_success:
@@ -96,6 +114,7 @@ def set_person_email(orcid_id, email, high_priority=False):
 def update_person(my_person, properties_to_change):
     for k, v in properties_to_change.iteritems():
         setattr(my_person, k, v)
+    my_person.invalidate_profile_json()
 
     db.session.merge(my_person)
     commit_success = safe_commit(db)
@@ -109,6 +128,7 @@ def update_promos(my_person, new_promos):
     # if you don't give it the key, it ignores it.
     for k, v in new_promos.iteritems():
         my_person.promos[k] = v
+    my_person.invalidate_profile_json()
 
     db.session.merge(my_person)
     commit_success = safe_commit(db)
@@ -120,6 +140,7 @@ def update_promos(my_person, new_promos):
 
 def set_person_claimed_at(my_person):
     my_person.claimed_at = datetime.datetime.utcnow().isoformat()
+    my_person.invalidate_profile_json()
     db.session.merge(my_person)
     commit_success = safe_commit(db)
     if not commit_success:
@@ -155,7 +176,7 @@ def make_temporary_person_from_orcid(orcid_id):
 
 
 def make_person(twitter_creds, high_priority=False, landing_page=None):
-    if Person.query.filter_by(twitter=twitter_creds["screen_name"]).first():
+    if with_load_profile(Person.query, "auth").filter_by(twitter=twitter_creds["screen_name"]).first():
         raise PersonExistsException
 
     my_person = Person()
@@ -184,14 +205,17 @@ def connect_orcid(my_person, orcid_id):
 
 
 def disconnect_twitter(my_person):
+    old_screen_name = my_person.twitter
     my_person.twitter_creds = None
     my_person.twitter = None
+    my_person.invalidate_profile_json()
     print u"\nDisconnected Twitter from: {}".format(my_person)
 
     db.session.add(my_person)
     commit_success = safe_commit(db)
     if not commit_success:
         print u"COMMIT fail on {}".format(my_person.id)
+    invalidate_cached_profile(screen_name=old_screen_name)
 
     return my_person
 
@@ -199,8 +223,10 @@ def connect_twitter(my_person, twitter_creds, set_everything_possible=False):
 
     full_twitter_profile = get_full_twitter_profile(twitter_creds)
     full_twitter_profile.update(twitter_creds)
+    old_screen_name = my_person.twitter
     my_person.twitter_creds = full_twitter_profile
     my_person.twitter = full_twitter_profile["screen_name"]
+    my_person.invalidate_profile_json()
 
     if set_everything_possible:
         my_person.email = full_twitter_profile["email"]
@@ -221,6 +247,8 @@ def connect_twitter(my_person, twitter_creds, set_everything_possible=False):
     commit_success = safe_commit(db)
     if not commit_success:
         print u"COMMIT fail on {}".format(my_person.id)
+    invalidate_cached_profile(screen_name=old_screen_name)
+    invalidate_cached_profile(screen_name=my_person.twitter)
 
     return my_person
 
@@ -237,6 +265,7 @@ def refresh_orcid_info_and_save(my_person):
     commit_success = safe_commit(db)
     if not commit_success:
         print u"COMMIT fail on {}".format(my_person.orcid_id)
+    invalidate_cached_profile(my_person.orcid_id)
     return my_person
 
 
@@ -248,7 +277,15 @@ def refresh_person(my_person, high_priority=False):
     # sleep(5)
     # return my_person
 
-    my_person.refresh(high_priority=high_priority)
+    # my_person was probably loaded for auth.  this is the same object, but now with
+    # the products, badges and raw api json it needs, in a few queries rather than one each
+    my_person = with_load_profile(Person.query, "refresh").filter_by(id=my_person.id).first()
+
+    # a lease so batch runs don't enqueue this person while we're refreshing them.
+    # if one already has, go ahead anyway: someone is waiting on this one.
+    with lease("Person.refresh", my_person.id):
+        with priority_lane(high_priority, seconds=interactive_refresh_seconds):
+            my_person.refresh(high_priority=high_priority)
     db.session.merge(my_person)
     commit_success = safe_commit(db)
     if not commit_success:
@@ -259,13 +296,16 @@ def refresh_person(my_person, high_priority=False):
 def refresh_profile(orcid_id, high_priority=False):
     print u"refreshing {}".format(orcid_id)
 
-    my_person = Person.query.options(orm.undefer('*')).filter_by(orcid_id=orcid_id).first()
+    my_person = with_load_profile(Person.query, "refresh").filter_by(orcid_id=orcid_id).first()
 
     # for testing on jason's local, so it doesn't have to do a real refresh
     # sleep(5)
     # return my_person
 
-    my_person.refresh(high_priority=high_priority)
+    # lease, as in refresh_person
+    with lease("Person.refresh", my_person.id):
+        with priority_lane(high_priority, seconds=interactive_refresh_seconds):
+            my_person.refresh(high_priority=high_priority)
     db.session.merge(my_person)
 
     commit_success = safe_commit(db)
@@ -277,10 +317,56 @@ def refresh_profile(orcid_id, high_priority=False):
     return my_person
 
 
+def get_profile_json(orcid_id):
+    # the stored profile snapshot, if there's a current one.  just the one column,
+    # so serving it doesn't load or compute anything else.
+    row = db.session.query(Person.profile_json).filter(
+        Person.orcid_id == orcid_id,
+        Person.profile_json_version == current_profile_json_version
+    ).first()
+    if not row:
+        return None
+    return row[0]
+
+
+def save_profile_json(my_person):
+    # for when there wasn't a snapshot to serve.  only fills in a missing or out of date
+    # one, so it can't overwrite a newer one that a refresh saved in the meantime.
+    profile_json = my_person.make_profile_json()
+    Person.query.filter(
+        Person.id == my_person.id,
+        or_(Person.profile_json_version == None, Person.profile_json_version != current_profile_json_version)
+    ).update({
+        "profile_json": profile_json,
+        "profile_json_version": current_profile_json_version
+    }, synchronize_session=False)
+    commit_success = safe_commit(db)
+    if not commit_success:
+        print u"COMMIT fail saving profile json for {}".format(my_person.orcid_id)
+    return profile_json
+
+
+def invalidate_profile_jsons_of_products(product_ids):
+    # for updates run on products: drops the snapshots of the people they belong to,
+    # in one statement, without loading anybody
+    orcid_ids = [row[0] for row in db.session.query(product.Product.orcid_id).filter(
+        product.Product.id.in_(product_ids),
+        product.Product.orcid_id != None
+    ).distinct()]
+    if orcid_ids:
+        Person.query.filter(Person.orcid_id.in_(orcid_ids)).update({
+            "profile_json": None,
+            "profile_json_version": None
+        }, synchronize_session=False)
+        for orcid_id in orcid_ids:
+            invalidate_cached_profile_on_commit(orcid_id)
+    return orcid_ids
+
+
 def top_acheivement_persons(persons, achievements, limit):
 
     top_persons = (
-        Person.query.
+        with_load_profile(Person.query, "api-view").
             join(Person.badges).
             filter(Person.orcid_id.in_(persons), Badge.name.in_(achievements)).
             # group_by(Person.id).
@@ -294,7 +380,7 @@ def top_acheivement_persons(persons, achievements, limit):
     new_limit = limit - len(top_persons)
     if new_limit:
         top_persons_ids = [person.orcid_id for person in top_persons]
-        top_persons.extend(Person.query.filter(~Person.orcid_id.in_(top_persons_ids), Person.orcid_id.in_(persons)).
+        top_persons.extend(with_load_profile(Person.query, "api-view").filter(~Person.orcid_id.in_(top_persons_ids), Person.orcid_id.in_(persons)).
                            limit(new_limit).
                            all())
 
@@ -315,6 +401,12 @@ def get_sources(products):
     return sources
 
 
+# bump this when calculate changes how it computes things, so everyone gets recalculated
+calculate_version = 1
+
+# bump this when to_dict changes, so the stored profile snapshots stop being served
+current_profile_json_version = 1
+
 class Person(db.Model):
     id = db.Column(db.Text, primary_key=True)
     orcid_id = db.Column(db.Text, unique=True)
@@ -327,6 +419,7 @@ class Person(db.Model):
     claimed_at = db.Column(db.DateTime)
 
     orcid_api_raw_json = deferred(db.Column(JSONB))
+    orcid_last_modified = db.Column(db.DateTime)
     fresh_orcid = db.Column(db.Boolean)
     invalid_orcid = db.Column(db.Boolean)
 
@@ -365,26 +458,36 @@ class Person(db.Model):
 
     coauthors = db.Column(MutableDict.as_mutable(JSONB))
     promos = db.Column(MutableDict.as_mutable(JSONB))
+    calculate_digests = db.Column(MutableDict.as_mutable(JSONB))
+
+    # to_dict() as the profile endpoints serve it, made by calculate.  see get_profile_json
+    profile_json = deferred(db.Column(db.Text))
+    profile_json_version = db.Column(db.Integer)
 
     error = db.Column(db.Text)
 
+    # loaded when touched.  queries that need them say so with a load profile, see load_profiles.py
     products = db.relationship(
         'Product',
-        lazy='subquery',
+        lazy='select',
         cascade="all, delete-orphan",
-        backref=db.backref("person", lazy="subquery"),
+        backref=db.backref("person", lazy="select"),
         foreign_keys="Product.orcid_id"
     )
 
     badges = db.relationship(
         'Badge',
-        lazy='subquery',
+        lazy='select',
         cascade="all, delete-orphan",
-        backref=db.backref("person", lazy="subquery"),
+        backref=db.backref("person", lazy="select"),
         foreign_keys="Badge.orcid_id"
     )
 
 
+    # set by set_api_raw_from_orcid when the orcid record hasn't changed since we last got it.
+    # not stored.
+    orcid_unchanged = False
+
     def __init__(self):
         self.invalid_orcid = False
 
@@ -410,7 +513,10 @@ class Person(db.Model):
             print u"not calling orcid because no overwrite"
         print u"elapsed in call_apis after set_api_raw_from_orcid is {}s".format(elapsed(start_time, 2))
 
-        self.set_from_orcid()
+        if self.orcid_unchanged and self.products:
+            print u"orcid record unchanged since {}, so not rebuilding products".format(self.orcid_last_modified)
+        else:
+            self.set_from_orcid()
         print u"set_from_orcid took {}s".format(elapsed(start_time, 2))
         print u"elapsed in call_apis after set_from_orcid is {}s".format(elapsed(start_time, 2))
 
@@ -452,7 +558,8 @@ class Person(db.Model):
             self.call_apis(overwrite_orcid=False, overwrite_metrics=False)
 
             print u"** calling calculate"
-            self.calculate()
+            with job_stage("calculate"):
+                self.calculate()
         except (KeyboardInterrupt, SystemExit):
             # let these ones through, don't save anything to db
             raise
@@ -469,9 +576,13 @@ class Person(db.Model):
             print u"in generic exception handler, so rolling back in case it is needed"
             db.session.rollback()
         finally:
-            self.updated = datetime.datetime.utcnow().isoformat()
+            # a datetime, as it loads from the db, so the profile formats it the same either way
+            self.updated = datetime.datetime.utcnow()
             if self.error:
                 print u"ERROR refreshing person {}: {}".format(self.id, self.error)
+                self.invalidate_profile_json()
+            else:
+                self.set_profile_json_updated()
 
 
     # doesn't throw errors; sets error column if error
@@ -481,13 +592,15 @@ class Person(db.Model):
         start_time = time()
         try:
             print u"** calling call_apis"
-            self.call_apis(high_priority=high_priority)
+            with job_stage("call_apis"):
+                self.call_apis(high_priority=high_priority)
             print u"** after call_apis, at {sec}s elapsed".format(
                 sec=elapsed(start_time)
             )
 
             print u"** calling calculate"
-            self.calculate()
+            with job_stage("calculate"):
+                self.calculate()
             print u"** after calculate, at {sec}s elapsed".format(
                 sec=elapsed(start_time)
             )
@@ -515,9 +628,12 @@ class Person(db.Model):
             print u"in generic exception handler, so rolling back in case it is needed"
             db.session.rollback()
         finally:
-            self.updated = datetime.datetime.utcnow().isoformat()
+            self.updated = datetime.datetime.utcnow()  # a datetime, as in refresh_from_db
             if self.error:
                 print u"ERROR refreshing person {}: {}".format(self.id, self.error)
+                self.invalidate_profile_json()
+            else:
+                self.set_profile_json_updated()
 
 
     def set_mendeley(self, high_priority=False):
@@ -544,21 +660,88 @@ class Person(db.Model):
 
 
     def set_products(self, products_to_add):
-        updated_products = []
+        if not inspect(self).persistent:
+            # a temporary person, or one we haven't saved yet, so there are no rows to match
+            self.products = products_to_add
+            return
+
+        # works are keyed on their orcid put-code.  ones we have already are only touched if
+        # their orcid record changed, and then all in one UPDATE.  ones that vanished go in one
+        # DELETE, and new ones in one INSERT, rather than leaving the orm to diff the whole list
+        # row by row.  works without a put-code can't be matched, so they're always replaced.
+        existing_by_put_code = {}
+        for my_existing_product in self.products:
+            if my_existing_product.orcid_put_code is not None:
+                existing_by_put_code[str(my_existing_product.orcid_put_code)] = my_existing_product
 
+        updated_products = []
+        changed_products = []
+        new_products = []
+        seen_put_codes = set()
         for product_to_add in products_to_add:
-            needs_to_be_added = True
-            for my_existing_product in self.products:
-                if str(my_existing_product.orcid_put_code) == str(product_to_add.orcid_put_code):
+            if product_to_add.orcid_put_code is None:
+                my_existing_product = None
+            else:
+                put_code = str(product_to_add.orcid_put_code)
+                if put_code in seen_put_codes:
+                    continue
+                seen_put_codes.add(put_code)
+                my_existing_product = existing_by_put_code.get(put_code, None)
+
+            if my_existing_product:
+                if my_existing_product.orcid_api_raw_json != product_to_add.orcid_api_raw_json:
                     # update the product biblio from the most recent orcid api response
                     my_existing_product.orcid_api_raw_json = product_to_add.orcid_api_raw_json
                     my_existing_product.set_biblio_from_orcid()
-
-                    updated_products.append(my_existing_product)
-                    needs_to_be_added = False
-            if needs_to_be_added:
+                    changed_products.append(my_existing_product)
+                updated_products.append(my_existing_product)
+            else:
+                product_to_add.orcid_id = self.orcid_id
+                new_products.append(product_to_add)
                 updated_products.append(product_to_add)
-        self.products = updated_products
+
+        if changed_products:
+            # every row gets every column any of them changed, so it's one executemany UPDATE
+            changed_columns = set()
+            for my_changed_product in changed_products:
+                product_state = inspect(my_changed_product)
+                for column in product_state.mapper.column_attrs.keys():
+                    if product_state.attrs[column].history.has_changes():
+                        changed_columns.add(column)
+            mappings = []
+            with db.session.no_autoflush:  # loading a column mustn't flush them the slow way first
+                for my_changed_product in changed_products:
+                    mapping = dict([(column, getattr(my_changed_product, column)) for column in changed_columns])
+                    mapping["id"] = my_changed_product.id
+                    mappings.append(mapping)
+            db.session.bulk_update_mappings(product.Product, mappings)
+            for my_changed_product in changed_products:
+                # they're written now, so there's nothing left for the orm to flush
+                for column in changed_columns:
+                    set_committed_value(my_changed_product, column, getattr(my_changed_product, column))
+
+        updated_ids = set([p.id for p in updated_products])
+        vanished_products = [p for p in self.products if p.id not in updated_ids]
+        if vanished_products:
+            product.Product.query.filter(
+                product.Product.id.in_([p.id for p in vanished_products])
+            ).delete(synchronize_session=False)
+            for my_vanished_product in vanished_products:
+                db.session.expunge(my_vanished_product)
+
+        if new_products:
+            columns = [column.key for column in product.Product.__table__.columns]
+            rows = [dict([(column, getattr(p, column)) for column in columns]) for p in new_products]
+            db.session.execute(product.Product.__table__.insert().values(rows))
+            for my_new_product in new_products:
+                # they're in the db now, so the orm treats them as loaded rather than inserting them again
+                for column in columns:
+                    set_committed_value(my_new_product, column, getattr(my_new_product, column))
+                orm.make_transient_to_detached(my_new_product)
+                db.session.add(my_new_product)
+
+        # the rows are already right, so this isn't a change for the orm to flush
+        set_committed_value(self, "products", updated_products)
 
 
     def recalculate_openness(self):
@@ -690,7 +873,7 @@ class Person(db.Model):
         self.set_num_products()
 
 
-    def calculate(self):
+    def calculate(self, force=False):
         # things with api calls in them, or things needed to make those calls
         start_time = time()
         self.set_fulltext_urls()
@@ -701,32 +884,123 @@ class Person(db.Model):
             sec = elapsed(start_time, 2)
         )
 
-        # everything else
+        # only redo the parts whose inputs changed since the last calculate
         start_time = time()
-        self.set_post_counts() # do this first
-        self.set_mendeley_sums()
-        self.set_num_posts()
-        self.set_num_mentions()
-        self.set_num_products()
-        self.set_openness()  # do after set_fulltext_urls
-        self.set_num_oa_licenses() # do after set_fulltext_urls, before assign_badges
-        self.set_event_counts()
-        self.set_coauthors()  # do this last, uses scores
+        old_digests = self.calculate_digests or {}
+        new_digests = self.get_calculate_digests()
+        changed = [stage for stage in new_digests if force or old_digests.get(stage) != new_digests[stage]]
+        if not changed:
+            print u"nothing changed since last {method_name}, so skipping the rest".format(
+                method_name="calculate".upper())
+            # the profile shows things calculate doesn't digest, like names, so remake it anyway
+            self.set_profile_json()
+            return
+        print u"recalculating {}".format(sorted(changed))
+
+        # everything else
+        if "posts" in changed:
+            self.set_post_counts() # do this first
+            self.set_num_posts()
+            self.set_num_mentions()
+        if "mendeley" in changed:
+            self.set_mendeley_sums()
+        if "openness" in changed:
+            self.set_num_products()
+            self.set_openness()  # do after set_fulltext_urls
+            self.set_num_oa_licenses() # do after set_fulltext_urls, before assign_badges
+        if "events" in changed:
+            self.set_event_counts()
+        if "coauthors" in changed:
+            self.set_coauthors()  # do this last, uses scores
         print u"finished calculating part of {method_name} on {num} products in {sec}s".format(
             method_name="calculate".upper(),
             num = len(self.products),
             sec = elapsed(start_time, 2)
         )
 
-        start_time = time()
-        self.assign_badges()
-        self.set_badge_percentiles()
+        if "badges" in changed:
+            start_time = time()
+            self.assign_badges()
+            self.set_badge_percentiles()
 
-        print u"finished badges part of {method_name} on {num} products in {sec}s".format(
-            method_name="calculate".upper(),
-            num = len(self.products),
-            sec = elapsed(start_time, 2)
-        )
+            print u"finished badges part of {method_name} on {num} products in {sec}s".format(
+                method_name="calculate".upper(),
+                num = len(self.products),
+                sec = elapsed(start_time, 2)
+            )
+
+        self.calculate_digests = new_digests
+        self.set_profile_json()
+
+
+    def make_profile_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True, default=json_dumper, indent=4)
+
+    def set_profile_json(self):
+        # snapshot what the profile endpoints serve, see get_profile_json
+        self.profile_json = self.make_profile_json()
+        self.profile_json_version = current_profile_json_version
+        invalidate_cached_profile_on_commit(self.orcid_id)
+        return self.profile_json
+
+    def invalidate_profile_json(self):
+        # for when something the profile shows changed, and we haven't got the products
+        # loaded to make a new snapshot.  the next read makes one.
+        self.profile_json = None
+        self.profile_json_version = None
+        invalidate_cached_profile_on_commit(self.orcid_id)
+
+    def set_profile_json_updated(self):
+        # refresh sets updated after calculate made the snapshot, so patch it in
+        if self.profile_json_version != current_profile_json_version or not self.profile_json:
+            return
+        profile = json.loads(self.profile_json)
+        profile["updated"] = date_as_iso_utc(self.updated)
+        self.profile_json = json.dumps(profile, sort_keys=True, indent=4)
+        invalidate_cached_profile_on_commit(self.orcid_id)
+
+
+    def get_calculate_digests(self):
+        # a fingerprint of the inputs to each part of calculate
+        products = self.all_products
+        today = datetime.datetime.utcnow().date()
+
+        # event counts (and the hot streak badge) depend on today's date, but only
+        # while there are events in the last month.  after that they stay at zero.
+        event_dates = self.get_event_dates()
+        if event_dates and days_ago(event_dates[-1]) <= 31:
+            events_clock = today.isoformat()
+        else:
+            events_clock = "quiet"
+
+        digests = {
+            "posts": fingerprint(
+                calculate_version,
+                [(p.id, p.doi, p.post_details) for p in products]),
+            "mendeley": fingerprint(
+                calculate_version,
+                [(p.id, p.mendeley_api_raw) for p in products]),
+            "openness": fingerprint(
+                calculate_version,
+                [(p.id, p.doi, p.fulltext_url, p.user_supplied_fulltext_url, p.license) for p in products]),
+            "events": fingerprint(
+                calculate_version,
+                [(p.id, p.doi, p.event_dates) for p in products],
+                events_clock),
+            # coauthors come from other people's profiles too, so redo them weekly regardless
+            "coauthors": fingerprint(
+                calculate_version,
+                sorted([p.doi for p in products if p.doi]),
+                today.isocalendar()[0:2]),
+            "badges": fingerprint(
+                calculate_version,
+                [p.input_fingerprint for p in products],
+                self.depsy_id,
+                self.depsy_percentile,
+                events_clock,
+                get_refsets_stamp())
+        }
+        return digests
 
     def mini_calculate(self):
         self.set_num_posts()
@@ -741,7 +1015,7 @@ class Person(db.Model):
             url = "http://depsy.org/api/search/person?email={}".format(self.email)
             # might throw requests.Timeout
             try:
-                r = requests.get(url, headers=headers, timeout=10)
+                r = provider_get("depsy", url, headers=headers)
             except requests.Timeout:
                 print u"timeout in set_depsy"
                 return
@@ -770,10 +1044,25 @@ class Person(db.Model):
     def set_api_raw_from_orcid(self):
         start_time = time()
 
+        self.orcid_unchanged = False
+
+        # only ask for the record if it changed since our copy
+        modified_since = None
+        if self.orcid_last_modified and self.orcid_api_raw_json:
+            modified_since = self.orcid_last_modified
+
         # look up profile in orcid
         try:
-            orcid_data = make_and_populate_orcid_profile(self.orcid_id)
-            self.orcid_api_raw_json = orcid_data.api_raw_profile
+            orcid_data = make_and_populate_orcid_profile(self.orcid_id, modified_since)
+            if orcid_data.not_modified:
+                self.orcid_unchanged = True
+            elif modified_since and orcid_data.last_modified == modified_since:
+                # got it anyway (ORCID ignored If-Modified-Since, or it came from our cache),
+                # but it's the same record, so don't rewrite the big json column
+                self.orcid_unchanged = True
+            else:
+                self.orcid_api_raw_json = orcid_data.api_raw_profile
+                self.orcid_last_modified = orcid_data.last_modified
         except requests.Timeout:
             self.error = "timeout from requests when getting orcid"
 
@@ -871,22 +1160,13 @@ class Person(db.Model):
 
     def set_data_for_all_products(self, method_name, high_priority=False, include_products=None):
         start_time = time()
-        threads = []
 
         # use all products unless passed a specific set
         if not include_products:
             include_products = self.all_products
 
-        # start a thread for each product
-        for work in include_products:
-            method = getattr(work, method_name)
-            process = threading.Thread(target=method, args=[high_priority])
-            process.start()
-            threads.append(process)
-
-        # wait till all work is done
-        for process in threads:
-            process.join()
+        # runs on a bounded pool of threads, with per-provider limits on open calls
+        call_method_on_all(include_products, method_name, high_priority)
 
         # now go see if any of them had errors
         # need to do it this way because can't catch thread failures; have to check
@@ -24,6 +24,7 @@ from util import normalize
 from util import as_proportion
 from util import elapsed
 from util import cached_property
+from util import fingerprint
 
 from models.source import sources_metadata
 from models.source import Source
@@ -35,6 +36,7 @@ from models.orcid import set_biblio_from_biblio_dict
 from models.orcid import get_doi_from_biblio_dict
 from models.orcid import clean_doi
 from models.mendeley import set_mendeley_data
+from providers import provider_get
 
 preprint_url_fragments = [
     "/npre.",
@@ -130,6 +132,7 @@ class Product(db.Model):
 
     orcid_api_raw_json = deferred(db.Column(JSONB))
     altmetric_api_raw = deferred(db.Column(JSONB))
+    altmetric_api_raw_hash = db.Column(db.Text)  # so we can tell it changed without loading it
     # mendeley_api_raw = deferred(db.Column(JSONB)) #  @todo go back to this when done exploring
     mendeley_api_raw = db.Column(JSONB)
 
@@ -199,6 +202,29 @@ class Product(db.Model):
         self.set_post_details()
         self.set_event_dates()
 
+    @property
+    def input_fingerprint(self):
+        # everything Person.calculate reads off a product.  only non-deferred columns,
+        # so checking it doesn't load the big json blobs.
+        return fingerprint(
+            self.id,
+            self.doi,
+            self.title,
+            self.year,
+            self.type,
+            self.url,
+            self.journal,
+            self.authors_short,
+            self.altmetric_api_raw_hash,
+            self.altmetric_score,
+            self.post_details,
+            self.event_dates,
+            self.mendeley_api_raw,
+            self.user_supplied_fulltext_url,
+            self.fulltext_url,
+            self.license
+        )
+
     @property
     def display_authors(self):
         return self.authors_short
@@ -267,7 +293,7 @@ class Product(db.Model):
             # url = u"http://localhost:5002/v1/publications?email=team@impactstory.org"
             url = u"http://api.unpaywall.org/v2/{}?email=team+profiles@impactstory.org".format(self.doi)
 
-            r = requests.get(url)
+            r = provider_get("unpaywall", url, cache_id=self.doi)
             if r and r.status_code==200:
                 data = r.json()
                 if not self.journal:
@@ -539,7 +565,7 @@ class Product(db.Model):
             )
             # print u"url: {}".format(url)
             try:
-                r = requests.get(url, timeout=5)
+                r = provider_get("crossref", url)
                 if r.status_code==200 and r.text and u"|" in r.text:
                     doi = r.text.rsplit(u"|", 1)[1]
                     if doi and doi.startswith(u"10."):
@@ -575,17 +601,22 @@ class Product(db.Model):
                 key=os.getenv("ALTMETRIC_KEY")
             )
             # might throw requests.Timeout
-            r = requests.get(url, timeout=10)  #timeout in seconds
+            r = provider_get("altmetric", url, cache_id=self.clean_doi)
 
-            # handle rate limit stuff
+            # handle rate limit stuff.  we're rate limited before calling, so this should be rare;
+            # wait our turn and try again before giving up on the twitter data.
             if r.status_code == 429:
-                print u"over altmetric.com rate limit (got 429) so calling without twitter"
+                print u"over altmetric.com rate limit (got 429) so waiting and trying again"
+                r = provider_get("altmetric", url, cache_id=self.clean_doi)
+
+            if r.status_code == 429:
+                print u"over altmetric.com rate limit (got 429) again so calling without twitter"
 
                 url = u"http://api.altmetric.com/v1/fetch/doi/{doi}?key={key}&exclude_sources=twitter".format(
                     doi=self.clean_doi,
                     key=os.getenv("ALTMETRIC_KEY")
                 )
-                r = requests.get(url, timeout=10)  #timeout in seconds
+                r = provider_get("altmetric", url, cache_id=self.clean_doi)
 
 
             # Altmetric.com doesn't have this DOI, so the DOI has no metrics.
@@ -611,6 +642,8 @@ class Product(db.Model):
             else:
                 self.error = u"got unexpected altmetric status_code code {}".format(r.status_code)
 
+            self.altmetric_api_raw_hash = fingerprint(self.altmetric_api_raw)
+
             # print u"after parsing in altmetric: {}s for {}".format(
             #     elapsed(start_time, 2), url)
 
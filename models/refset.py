@@ -2,8 +2,6 @@ from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import deferred
-from sqlalchemy.orm import Load
-from sqlalchemy import orm
 from sqlalchemy import text
 from sqlalchemy import func
 import datetime
@@ -13,6 +11,7 @@ from app import db
 
 from models.badge import Badge
 from models.badge import get_badge_assigner
+from models.load_profiles import with_load_profile
 from util import safe_commit
 from util import chunk_into_n_sublists
 
@@ -50,10 +49,7 @@ def update_refsets():
     print u"getting the badge percentile refsets...."
 
     # only get out the badge objects
-    q = db.session.query(Person).options(
-             Load(Person).load_only("campaign", "orcid_id"))
-    q = q.options(orm.noload('*'))
-    q = q.options(orm.subqueryload("badges"))
+    q = with_load_profile(db.session.query(Person), "refset")
 
     # limit to just what we want for the refset
     q = refine_refset_query(q)
@@ -103,6 +99,12 @@ def update_refsets():
 
 
 
+def get_refsets_stamp():
+    # changes whenever update_refsets saves new cutoffs, so calculate knows to redo percentiles
+    return db.session.query(func.max(Refset.updated)).scalar()
+
+
+
 class Refset(db.Model):
     name = db.Column(db.Text, primary_key=True)
     updated = db.Column(db.DateTime)
@@ -0,0 +1,110 @@
+import os
+import logging
+import hashlib
+import redis
+from sqlalchemy import event
+from sqlalchemy import orm
+
+from app import db
+from app import redis_rq_conn
+
+
+# finished responses for the profile endpoints, so repeat fetches (the frontend polling,
+# api users) don't hit postgres for the whole profile, and can get a 304 with an etag.
+#   profile-resp:{orcid_id}               hash of the body, its etag, and the person's
+#                                         updated when it was made.  it's only served
+#                                         while that still matches the db.
+#   profile-twitter-resp:{screen_name}    same, for the twitter screen name lookup
+# things that change a profile without changing updated call invalidate_cached_profile,
+# and so does anything that sets or drops the person's profile_json snapshot, once it commits.
+# if redis is down we just don't cache.
+profile_cache_seconds = int(os.getenv("PROFILE_CACHE_SECONDS", 60 * 60 * 24))
+
+
+def profile_cache_key(orcid_id):
+    return u"profile-resp:{}".format(orcid_id)
+
+def twitter_cache_key(screen_name):
+    return u"profile-twitter-resp:{}".format(screen_name)
+
+
+def make_etag(body):
+    if isinstance(body, unicode):
+        body = body.encode("utf-8")
+    return hashlib.md5(body).hexdigest()
+
+
+def get_cached_resp(key, updated=None):
+    # {"body": ..., "etag": ...} if we have it, and it was made as of updated
+    try:
+        cached = redis_rq_conn.hgetall(key)
+    except redis.RedisError:
+        logging.exception(u"couldn't get cached response {}".format(key))
+        return None
+    if not cached or "body" not in cached:
+        return None
+    if cached.get("updated", "") != unicode(updated):
+        return None
+    return cached
+
+
+def cache_resp(key, body, updated=None):
+    # returns the etag, whether or not it could be cached
+    etag = make_etag(body)
+    try:
+        pipe = redis_rq_conn.pipeline()
+        pipe.delete(key)
+        pipe.hmset(key, {
+            "body": body,
+            "etag": etag,
+            "updated": unicode(updated)
+        })
+        pipe.expire(key, profile_cache_seconds)
+        pipe.execute()
+    except redis.RedisError:
+        logging.exception(u"couldn't cache response {}".format(key))
+    return etag
+
+
+def get_cached_profile(orcid_id, updated):
+    return get_cached_resp(profile_cache_key(orcid_id), updated)
+
+def cache_profile(orcid_id, updated, body):
+    return cache_resp(profile_cache_key(orcid_id), body, updated)
+
+
+def get_cached_twitter_lookup(screen_name):
+    return get_cached_resp(twitter_cache_key(screen_name))
+
+def cache_twitter_lookup(screen_name, body):
+    return cache_resp(twitter_cache_key(screen_name), body)
+
+
+def invalidate_cached_profile(orcid_id=None, screen_name=None):
+    keys = []
+    if orcid_id:
+        keys.append(profile_cache_key(orcid_id))
+    if screen_name:
+        keys.append(twitter_cache_key(screen_name))
+    if not keys:
+        return
+    try:
+        redis_rq_conn.delete(*keys)
+    except redis.RedisError:
+        logging.exception(u"couldn't invalidate cached responses {}".format(keys))
+
+
+# orcid ids whose profile_json snapshot changed in this session's transaction.  their
+# cached responses go once it commits, not before, so a read in between can't cache
+# the old snapshot again.
+def invalidate_cached_profile_on_commit(orcid_id):
+    if orcid_id:
+        db.session().info.setdefault("stale_profile_orcid_ids", set()).add(orcid_id)
+
+
+@event.listens_for(orm.Session, "after_commit")
+def invalidate_stale_cached_profiles(session):
+    if session.transaction is not None and session.transaction.nested:
+        return  # just a savepoint, the snapshot isn't visible to anyone else yet
+    for orcid_id in session.info.pop("stale_profile_orcid_ids", []):
+        invalidate_cached_profile(orcid_id)
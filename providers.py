@@ -0,0 +1,488 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import Queue
+import requests
+import redis
+from requests.adapters import HTTPAdapter
+from contextlib import contextmanager
+from time import time
+from time import sleep
+
+from app import redis_rq_conn
+from util import elapsed
+from job_metrics import job_stage
+
+
+# the external apis we call, how many calls we let run against each host at once,
+# and how long (in seconds) we wait on any one call.
+# the per-host limits are shared by every person being refreshed in this process,
+# so a web dyno refreshing two profiles still only has this many calls open to altmetric.
+# they also size the keep-alive connection pool for that provider's session.
+# providers with a rate_per_second are rate limited across all our workers, see wait_for_rate_limit.
+# providers with a cache_ttl (seconds) keep their responses in the provider cache, see provider_get.
+default_timeout = int(os.getenv("PROVIDER_TIMEOUT", 10))
+
+provider_configs = {
+    "altmetric": {
+        "host": "api.altmetric.com",
+        "max_concurrent": int(os.getenv("ALTMETRIC_MAX_CONCURRENT", 8)),
+        "timeout": default_timeout,
+        "rate_per_second": float(os.getenv("ALTMETRIC_RATE_LIMIT", 10)),
+        "burst": int(os.getenv("ALTMETRIC_RATE_BURST", 20)),
+        "cache_ttl": int(os.getenv("ALTMETRIC_CACHE_TTL", 60 * 60 * 12))
+    },
+    "unpaywall": {
+        "host": "api.unpaywall.org",
+        "max_concurrent": int(os.getenv("UNPAYWALL_MAX_CONCURRENT", 8)),
+        "timeout": default_timeout,
+        "rate_per_second": float(os.getenv("UNPAYWALL_RATE_LIMIT", 10)),
+        "burst": int(os.getenv("UNPAYWALL_RATE_BURST", 20)),
+        "cache_ttl": int(os.getenv("UNPAYWALL_CACHE_TTL", 60 * 60 * 24 * 7))
+    },
+    "crossref": {
+        "host": "doi.crossref.org",
+        "max_concurrent": int(os.getenv("CROSSREF_MAX_CONCURRENT", 4)),
+        "timeout": 5,
+        "rate_per_second": float(os.getenv("CROSSREF_RATE_LIMIT", 10)),
+        "burst": int(os.getenv("CROSSREF_RATE_BURST", 20))
+    },
+    "mendeley": {
+        "host": "api.mendeley.com",
+        "max_concurrent": int(os.getenv("MENDELEY_MAX_CONCURRENT", 4)),
+        "timeout": default_timeout
+    },
+    "orcid": {
+        "host": "pub.orcid.org",
+        "max_concurrent": int(os.getenv("ORCID_MAX_CONCURRENT", 4)),
+        "timeout": default_timeout,
+        "cache_ttl": int(os.getenv("ORCID_CACHE_TTL", 60 * 60))
+    },
+    "depsy": {
+        "host": "depsy.org",
+        "max_concurrent": 2,
+        "timeout": default_timeout
+    },
+}
+
+# which provider each of the Product methods we fan out actually calls
+product_method_providers = {
+    "set_data_from_altmetric": "altmetric",
+    "set_data_from_oadoi": "unpaywall",
+    "set_doi_from_crossref_biblio_lookup": "crossref",
+    "set_data_from_mendeley": "mendeley",
+}
+
+# most worker threads one call_method_on_all will start, however many objects it gets
+max_concurrent_calls = int(os.getenv("PROVIDER_MAX_CONCURRENT_CALLS", 10))
+
+# the high priority lane is for refreshes someone is waiting on.  batch calls leave this
+# fraction of each rate limited provider's burst for it, and back off entirely while
+# any high priority refresh is running.  see wait_for_rate_limit.
+high_priority_reserve = float(os.getenv("PROVIDER_HIGH_PRIORITY_RESERVE", 0.25))
+
+# interactive refreshes have to finish inside the gunicorn timeout (30sec by default),
+# so their provider calls get whatever is left of this many seconds.
+interactive_refresh_seconds = int(os.getenv("INTERACTIVE_REFRESH_SECONDS", 25))
+
+
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+def get_session(provider_name):
+    global _sessions_pid
+
+    with _sessions_lock:
+        # the pooled sockets can't be shared with a forked child (rq forks for every job),
+        # so each process builds its own sessions.  don't close the parent's, they're still in use there.
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+
+        if provider_name not in _sessions:
+            pool_size = provider_configs[provider_name]["max_concurrent"]
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[provider_name] = session
+
+        return _sessions[provider_name]
+
+
+def provider_get(provider_name, url, cache_id=None, **kwargs):
+    # like requests.get, but reuses this provider's keep-alive connections
+    # and waits its turn under the provider's rate limit.
+    # pass a cache_id (the doi, orcid id, etc) to use the provider cache.  batch calls reuse
+    # cached responses until their ttl; high priority ones always revalidate.
+    # might throw requests.Timeout
+    kwargs.setdefault("timeout", provider_configs[provider_name]["timeout"])
+
+    deadline = get_lane_deadline()
+    if deadline:
+        kwargs["timeout"] = min(kwargs["timeout"], seconds_left_before(deadline))
+
+    with job_stage(u"provider:{}".format(provider_name)):
+        cache_ttl = provider_configs[provider_name].get("cache_ttl", None)
+        if cache_id and cache_ttl:
+            return cached_provider_get(provider_name, url, cache_id, cache_ttl, **kwargs)
+
+        wait_for_rate_limit(provider_name)
+        return get_session(provider_name).get(url, **kwargs)
+
+
+
+# the provider cache.  lives in its own redis if PROVIDER_CACHE_REDIS_URL is set, because
+# altmetric payloads are big and we don't want them crowding out the rq queues.
+if os.getenv("PROVIDER_CACHE_REDIS_URL"):
+    provider_cache_conn = redis.from_url(os.getenv("PROVIDER_CACHE_REDIS_URL"), db=0)
+else:
+    provider_cache_conn = redis_rq_conn
+
+# after its ttl, a response we can revalidate (has an etag or last-modified)
+# is kept this much longer so we can send a conditional request for it.
+provider_cache_stale_seconds = int(os.getenv("PROVIDER_CACHE_STALE_SECONDS", 60 * 60 * 24 * 30))
+
+# only these are stable enough to keep.  a 404 from altmetric means "no metrics for this doi".
+cacheable_status_codes = [200, 404]
+
+
+class CachedResponse(object):
+    # just enough of requests.Response for the code that calls provider_get
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+    def __nonzero__(self):
+        return self.status_code < 400
+
+
+def provider_cache_key(provider_name, cache_id, url):
+    # the url is in the key too because some providers get called a few ways for one id
+    url_hash = hashlib.md5(url.encode("utf-8")).hexdigest()[0:10]
+    return u"provider-cache:{}:{}:{}".format(provider_name, cache_id, url_hash)
+
+
+def count_provider_cache(provider_name, outcome):
+    try:
+        provider_cache_conn.hincrby("provider-cache-stats", u"{}:{}".format(provider_name, outcome), 1)
+    except redis.RedisError:
+        pass
+
+
+def provider_cache_stats():
+    # like {"altmetric": {"hit": 10, "miss": 4, "revalidated": 2}}
+    ret = {}
+    for field, count in provider_cache_conn.hgetall("provider-cache-stats").iteritems():
+        (provider_name, outcome) = field.rsplit(":", 1)
+        ret.setdefault(provider_name, {})[outcome] = int(count)
+    return ret
+
+
+def cached_provider_get(provider_name, url, cache_id, cache_ttl, **kwargs):
+    key = provider_cache_key(provider_name, cache_id, url)
+
+    try:
+        cached = provider_cache_conn.hgetall(key)
+    except redis.RedisError:
+        logging.exception(u"couldn't read provider cache for {}".format(key))
+        cached = {}
+
+    # someone waiting on a refresh (say, right after editing their orcid record) wants what
+    # the provider has now, so in the high priority lane we always check, conditionally if we can
+    if cached and time() - float(cached["fetched"]) < cache_ttl and not is_high_priority_lane():
+        count_provider_cache(provider_name, "hit")
+        return CachedResponse(int(cached["status_code"]), cached["text"].decode("utf-8"))
+
+    # stale (or we're checking anyway), but maybe the provider can tell us it hasn't changed
+    headers = dict(kwargs.pop("headers", None) or {})
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    wait_for_rate_limit(provider_name)
+    r = get_session(provider_name).get(url, headers=headers, **kwargs)
+
+    if r.status_code == 304 and cached:
+        count_provider_cache(provider_name, "revalidated")
+        store_provider_cache(key, cached, cache_ttl)
+        return CachedResponse(int(cached["status_code"]), cached["text"].decode("utf-8"))
+
+    count_provider_cache(provider_name, "miss")
+    if r.status_code in cacheable_status_codes:
+        store_provider_cache(key, {
+            "status_code": r.status_code,
+            "text": r.text.encode("utf-8"),
+            "etag": r.headers.get("ETag", ""),
+            "last_modified": r.headers.get("Last-Modified", "")
+        }, cache_ttl)
+    return r
+
+
+def store_provider_cache(key, entry, cache_ttl):
+    entry["fetched"] = time()
+    expire_seconds = cache_ttl
+    if entry.get("etag") or entry.get("last_modified"):
+        expire_seconds += provider_cache_stale_seconds
+
+    try:
+        pipe = provider_cache_conn.pipeline()
+        pipe.hmset(key, entry)
+        pipe.expire(key, int(expire_seconds))
+        pipe.execute()
+    except redis.RedisError:
+        logging.exception(u"couldn't write provider cache for {}".format(key))
+
+
+
+# token bucket, shared by every worker through redis.  refills at rate tokens per second,
+# holds at most burst tokens.  takes a token and returns 0 if there is one,
+# otherwise takes nothing and returns how many seconds until there will be.
+# a batch caller (ARGV[4] is 0) has to leave `reserve` tokens in the bucket, and while
+# any high priority refresh in KEYS[2] hasn't expired it only gets a token from a full bucket.
+token_bucket_lua = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local high_priority = tonumber(ARGV[4])
+local reserve = tonumber(ARGV[5])
+
+local tokens = tonumber(redis.call("hget", KEYS[1], "tokens"))
+local updated = tonumber(redis.call("hget", KEYS[1], "updated"))
+if tokens == nil or updated == nil then
+    tokens = burst
+    updated = now
+end
+
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+local floor = 0
+if high_priority == 0 then
+    floor = reserve
+    if redis.call("zcount", KEYS[2], now, "+inf") > 0 then
+        floor = math.max(reserve, burst - 1)
+    end
+end
+
+local wait = 0
+if tokens >= 1 + floor then
+    tokens = tokens - 1
+else
+    wait = (1 + floor - tokens) / rate
+end
+
+redis.call("hmset", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("expire", KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+token_bucket_script = redis_rq_conn.register_script(token_bucket_lua)
+
+def wait_for_rate_limit(provider_name):
+    config = provider_configs[provider_name]
+    if not config.get("rate_per_second"):
+        return
+
+    key = u"ratelimit:{}".format(provider_name)
+    high_priority = is_high_priority_lane()
+    reserve = int(config["burst"] * high_priority_reserve)
+    deadline = get_lane_deadline()
+    while True:
+        try:
+            wait_seconds = float(token_bucket_script(
+                keys=[key, high_priority_active_key],
+                args=[config["rate_per_second"], config["burst"], time(), int(high_priority), reserve]
+            ))
+        except redis.RedisError:
+            # don't stop calling the apis just because redis is unhappy
+            logging.exception(u"couldn't check rate limit for {}".format(provider_name))
+            return
+
+        if wait_seconds <= 0:
+            return
+        if deadline and time() + wait_seconds > deadline:
+            # someone is waiting on this; one call over the limit beats a timed out page
+            return
+        sleep(wait_seconds)
+
+
+
+# which lane this thread's provider calls are in.  call_method_on_all passes it on to its threads.
+_lane = threading.local()
+
+class ProviderDeadlineExceeded(requests.Timeout):
+    # out of time for someone waiting on a refresh, so the call isn't made at all
+    pass
+
+def seconds_left_before(deadline):
+    seconds_left = deadline - time()
+    if seconds_left <= 0:
+        raise ProviderDeadlineExceeded(u"past the deadline for this refresh")
+    return seconds_left
+
+# the high priority refreshes running right now, across all dynos, scored by when
+# they'll be over even if the dyno running them dies
+high_priority_active_key = "provider-high-priority-active"
+
+def is_high_priority_lane():
+    return getattr(_lane, "high_priority", False)
+
+def get_lane_deadline():
+    return getattr(_lane, "deadline", None)
+
+
+@contextmanager
+def priority_lane(high_priority, seconds=None, deadline=None, announce=True):
+    # provider calls made inside this block go in the high priority lane,
+    # and time out by the deadline (seconds from now) if there is one.
+    # announce tells batch work across all dynos to back off until we're done.
+    if not high_priority:
+        yield
+        return
+
+    previous = (is_high_priority_lane(), get_lane_deadline())
+    _lane.high_priority = True
+    if seconds:
+        deadline = time() + seconds
+    _lane.deadline = deadline or previous[1]
+
+    announced = None
+    if announce and not previous[0]:
+        announced = u"{}:{}:{}".format(os.getpid(), threading.current_thread().ident, time())
+        expires = _lane.deadline or time() + interactive_refresh_seconds * 2
+        try:
+            pipe = redis_rq_conn.pipeline()
+            pipe.zremrangebyscore(high_priority_active_key, "-inf", time())
+            pipe.zadd(high_priority_active_key, announced, expires)
+            pipe.expire(high_priority_active_key, int(expires - time()) + 60)
+            pipe.execute()
+        except redis.RedisError:
+            logging.exception(u"couldn't announce high priority refresh")
+
+    try:
+        yield
+    finally:
+        (_lane.high_priority, _lane.deadline) = previous
+        if announced:
+            try:
+                redis_rq_conn.zrem(high_priority_active_key, announced)
+            except redis.RedisError:
+                logging.exception(u"couldn't finish high priority refresh")
+
+
+
+_provider_semaphores = {}
+_provider_semaphores_lock = threading.Lock()
+
+def get_provider_semaphore(provider_name):
+    with _provider_semaphores_lock:
+        if provider_name not in _provider_semaphores:
+            max_concurrent = provider_configs[provider_name]["max_concurrent"]
+            _provider_semaphores[provider_name] = threading.BoundedSemaphore(max_concurrent)
+        return _provider_semaphores[provider_name]
+
+
+@contextmanager
+def provider_slot(provider_name):
+    # blocks until there is room for one more call to this provider's host,
+    # or raises ProviderDeadlineExceeded if the lane's deadline passes first
+    if not provider_name:
+        yield
+        return
+
+    semaphore = get_provider_semaphore(provider_name)
+    deadline = get_lane_deadline()
+    if deadline:
+        # py2 semaphores can't time out, so poll until there's room or we're out of time
+        while not semaphore.acquire(False):
+            sleep(min(0.05, seconds_left_before(deadline)))
+    else:
+        semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def call_method_on_all(objects, method_name, high_priority=False):
+    """
+    Runs obj.method_name(high_priority) on every object, using a small bounded
+    pool of threads instead of one thread per object.  Calls are also capped
+    per provider host, see provider_configs.
+    """
+    start_time = time()
+
+    provider_name = product_method_providers.get(method_name, None)
+
+    # our threads start in the batch lane, so tell them which lane we're in
+    high_priority = high_priority or is_high_priority_lane()
+    deadline = get_lane_deadline()
+
+    work_queue = Queue.Queue()
+    for obj in objects:
+        work_queue.put(obj)
+    skipped = [0]  # objects we ran out of time for
+
+    def run_calls():
+        with priority_lane(high_priority, deadline=deadline, announce=False):
+            run_calls_in_lane()
+
+    def run_calls_in_lane():
+        while True:
+            try:
+                obj = work_queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            if deadline and time() >= deadline:
+                # out of time, so leave the rest for the next refresh
+                skipped[0] += 1
+                continue
+
+            try:
+                with provider_slot(provider_name):
+                    getattr(obj, method_name)(high_priority)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except ProviderDeadlineExceeded:
+                skipped[0] += 1
+            except Exception:
+                # the methods set their own error attributes; just make sure
+                # one bad object doesn't stop this thread working through the rest
+                logging.exception(u"exception in {} on {}".format(method_name, obj))
+
+    num_threads = min(max_concurrent_calls, len(objects))
+    threads = []
+    for i in range(num_threads):
+        process = threading.Thread(target=run_calls)
+        process.start()
+        threads.append(process)
+
+    # wait till all work is done
+    for process in threads:
+        process.join()
+
+    if skipped[0]:
+        print u"call_method_on_all ran out of time, skipped {method_name} on {num} objects".format(
+            method_name=method_name,
+            num=skipped[0]
+        )
+    print u"call_method_on_all ran {method_name} on {num} objects with {num_threads} threads in {sec}s".format(
+        method_name=method_name,
+        num=len(objects),
+        num_threads=num_threads,
+        sec=elapsed(start_time, 2)
+    )
+
+
+
+if __name__ == "__main__":
+    # python providers.py  prints how much the provider cache has saved us
+    print json.dumps(provider_cache_stats(), sort_keys=True, indent=4)
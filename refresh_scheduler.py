@@ -0,0 +1,149 @@
+import os
+import argparse
+import datetime
+import logging
+from time import time
+from time import sleep
+
+from sqlalchemy import text
+
+from app import db
+from app import ti_queues
+from jobs import enqueue_routed_batch
+from jobs import get_queue_for_id
+from jobs import promote_due_retries
+from leases import acquire_leases
+from leases import get_leased_ids
+from leases import queued_lease_seconds
+from util import elapsed
+from models.person import Person
+
+
+# keeps refreshing people forever, the ones that most deserve it first, at a steady rate.
+# the provider budget is fixed, so it goes to the profiles people actually look at:
+# the longer since a profile was updated the more it's worth refreshing, and claimed
+# profiles and ones with recent events count for more.  profiles whose last refresh
+# errored count for less, so a broken one doesn't hog the budget.
+#   python refresh_scheduler.py --per-minute=60 --concurrency=8
+refreshes_per_minute = float(os.getenv("REFRESH_SCHEDULER_PER_MINUTE", 60))
+refresh_concurrency = int(os.getenv("REFRESH_SCHEDULER_CONCURRENCY", 8))
+min_hours_between_refreshes = float(os.getenv("REFRESH_SCHEDULER_MIN_HOURS", 24))
+claimed_weight = float(os.getenv("REFRESH_SCHEDULER_CLAIMED_WEIGHT", 4))
+error_weight = float(os.getenv("REFRESH_SCHEDULER_ERROR_WEIGHT", 0.25))
+
+seconds_between_ticks = 5
+seconds_between_candidate_queries = 60 * 5
+num_candidates = 500
+
+update_name = "Person.refresh"
+
+
+def get_refresh_candidates(limit=num_candidates):
+    # ids of the people most worth refreshing now, best first
+    now = datetime.datetime.utcnow()
+    q = text(u"""
+        select id from {table}
+        where orcid_id is not null
+        and (invalid_orcid is null or invalid_orcid = false)
+        and (updated is null or updated < :stale_before)
+        order by (
+            extract(epoch from (:now - coalesce(updated, created, :long_ago))) / 3600.0
+            * (case when claimed_at is not null then :claimed_weight else 1 end)
+            * (1 + ln(1 + greatest(coalesce(weekly_event_count, 0), 0)))
+            * (case when error is not null and error != '' then :error_weight else 1 end)
+        ) desc
+        limit :limit
+        """.format(table=Person.__tablename__))
+    rows = db.session.execute(q, {
+        "now": now,
+        "stale_before": now - datetime.timedelta(hours=min_hours_between_refreshes),
+        "long_ago": datetime.datetime(2000, 1, 1),
+        "claimed_weight": claimed_weight,
+        "error_weight": error_weight,
+        "limit": limit
+    }).fetchall()
+    db.session.remove()
+    return [row[0] for row in rows]
+
+
+def count_in_flight(in_flight):
+    # just our own refreshes, not whatever else is on the shared queues.  one is in flight
+    # until its job lets go of the lease we took for it (update_fn does, when it's done).
+    # in_flight is {id: when we enqueued it}, and loses the ones that have landed.
+    expired = [obj_id for (obj_id, enqueued_time) in in_flight.items() if elapsed(enqueued_time) > queued_lease_seconds]
+    for obj_id in expired:
+        del in_flight[obj_id]
+    still_leased = set(get_leased_ids(update_name, in_flight.keys()))
+    for obj_id in in_flight.keys():
+        if obj_id not in still_leased:
+            del in_flight[obj_id]
+    return len(in_flight)
+
+
+def run_scheduler(queue_number=None, per_minute=refreshes_per_minute, concurrency=refresh_concurrency):
+    # with no queue_number, each person goes to the queue their id hashes to
+    if queue_number is None:
+        queues = ti_queues
+    else:
+        queues = [ti_queues[queue_number]]
+    print u"refreshing {} people per minute, at most {} at once, on {}".format(
+        per_minute, concurrency, [queue.name for queue in queues])
+
+    candidates = []
+    candidates_time = 0
+    allowance = 0.0
+    last_tick_time = time()
+    num_enqueued = 0
+    start_time = time()
+    in_flight = {}  # the ids we've enqueued that haven't finished yet
+
+    while True:
+        # unused allowance carries over a little, so a busy queue doesn't lose us the whole minute
+        allowance = min(allowance + (time() - last_tick_time) * per_minute / 60.0, max(1, concurrency))
+        last_tick_time = time()
+
+        room = concurrency - count_in_flight(in_flight)
+        num_to_enqueue = min(int(allowance), room)
+
+        if num_to_enqueue > 0:
+            if not candidates or elapsed(candidates_time) > seconds_between_candidate_queries:
+                candidates = get_refresh_candidates()
+                candidates_time = time()
+
+            # leases skip anyone already queued or being refreshed from the web
+            obj_ids = []
+            while candidates and len(obj_ids) < num_to_enqueue:
+                next_ids = candidates[0:num_to_enqueue - len(obj_ids)]
+                candidates = candidates[len(next_ids):]
+                obj_ids += acquire_leases(update_name, next_ids)
+
+            if obj_ids:
+                if queue_number is None:
+                    queues_and_args = [(get_queue_for_id(obj_id), [Person, "refresh", [obj_id]]) for obj_id in obj_ids]
+                else:
+                    queues_and_args = [(queues[0], [Person, "refresh", [obj_id]]) for obj_id in obj_ids]
+                enqueue_routed_batch(queues_and_args, {"load_profile": "refresh"})
+                for obj_id in obj_ids:
+                    in_flight[obj_id] = time()
+                allowance -= len(obj_ids)
+                num_enqueued += len(obj_ids)
+                print u"enqueued {} refreshes ({} in {} min)".format(
+                    len(obj_ids), num_enqueued, round(elapsed(start_time) / 60, 1))
+
+        try:
+            promote_due_retries()
+        except Exception:
+            logging.exception("couldn't promote retries")
+
+        sleep(seconds_between_ticks)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep refreshing the profiles most worth refreshing.")
+    parser.add_argument('--queue', type=int, default=None, help="queue number to feed.  default is all of them, by id")
+    parser.add_argument('--per-minute', type=float, default=refreshes_per_minute, help="how many refreshes to start per minute")
+    parser.add_argument('--concurrency', type=int, default=refresh_concurrency, help="most refreshes queued or running at once")
+    parsed_args = parser.parse_args()
+
+    run_scheduler(parsed_args.queue, parsed_args.per_minute, parsed_args.concurrency)
@@ -1,46 +1,203 @@
 import optparse
 import os
 import sys
+import signal
+import resource
 import logging
+import traceback
+from time import sleep
 from rq import Worker
+from rq import SimpleWorker
 from rq import Queue
 from rq import Connection
 from rq.job import JobStatus
 from app import redis_rq_conn
 from app import ti_queues
+from app import ti_high_priority_queue
 import argparse
 
 
+# recycle a pre-forked worker after this many jobs, or once it has used this much memory
+worker_max_jobs = int(os.getenv("RQ_WORKER_MAX_JOBS", 500))
+worker_max_memory_mb = int(os.getenv("RQ_WORKER_MAX_MEMORY_MB", 400))
 
 
-def failed_job_handler(job, exc_type, exc_value, traceback):
+
+def failed_job_handler(job, exc_type, exc_value, tb):
 
     print "RQ job failed! {}. here's more: {} {} {}".format(
-        job.meta, exc_type, exc_value, traceback
+        job.meta, exc_type, exc_value, tb
     )
+
+    # an update_fn chunk: retry its ids one at a time instead of failing them all together
+    object_ids_chunk = job.meta.get("object_ids_chunk", None)
+    if object_ids_chunk and job.func_name == "jobs.update_fn":
+        from jobs import handle_update_failures
+        (cls, method_name) = job.args[0:2]
+        exception = u"".join(traceback.format_exception(exc_type, exc_value, tb))
+        failures = dict([(obj_id, exception) for obj_id in object_ids_chunk])
+        handle_update_failures(
+            cls,
+            method_name,
+            object_ids_chunk,
+            failures,
+            load_columns=job.kwargs.get("load_columns", None),
+            high_priority=job.kwargs.get("high_priority", False),
+            load_profile=job.kwargs.get("load_profile", None),
+            queue_name=job.origin
+        )
+        # the retries own these ids now, so as far as a named run goes this chunk is done
+        run_chunk = job.kwargs.get("run_chunk", None)
+        if run_chunk:
+            from update_runs import mark_run_chunks_done
+            mark_run_chunks_done(run_chunk[0], [run_chunk[1]])
+        return False  # handled, so it doesn't go on the failed queue too
+
     return True  # job failed, drop to next level error handling
 
-def start_worker(queue_name):
-    print "starting worker '{}'...".format(queue_name)
+def get_worker_queues(queue_names):
+    # the high priority queue is listed first, so it's always emptied before ours
+    return [Queue(ti_high_priority_queue.name)] + [Queue(name) for name in queue_names]
+
+
+def start_worker(queue_names):
+    print "starting worker on {}...".format(queue_names)
 
     with Connection(redis_rq_conn):
-        worker = Worker(Queue(queue_name), exc_handler=failed_job_handler)
+        worker = Worker(get_worker_queues(queue_names), exc_handler=failed_job_handler)
         worker.work()
 
 
 
+class RecyclingWorker(SimpleWorker):
+    """
+    Runs jobs in its own process instead of forking for each one, and exits
+    after max_jobs jobs or max_memory_mb of memory so the supervisor starts a fresh one.
+    """
+    def __init__(self, *args, **kwargs):
+        self.max_jobs = kwargs.pop("max_jobs", None)
+        self.max_memory_mb = kwargs.pop("max_memory_mb", None)
+        self.num_jobs_done = 0
+        super(RecyclingWorker, self).__init__(*args, **kwargs)
+
+    def execute_job(self, *args, **kwargs):
+        response = super(RecyclingWorker, self).execute_job(*args, **kwargs)
+        self.num_jobs_done += 1
+
+        # maxrss is in kilobytes on linux
+        memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        if self.max_jobs and self.num_jobs_done >= self.max_jobs:
+            print u"worker {} did {} jobs, recycling".format(os.getpid(), self.num_jobs_done)
+            raise SystemExit(0)
+        if self.max_memory_mb and memory_mb >= self.max_memory_mb:
+            print u"worker {} is using {}MB, recycling".format(os.getpid(), memory_mb)
+            raise SystemExit(0)
+        return response
+
+
+def run_preforked_worker(queue_names, max_jobs, max_memory_mb):
+    # the parent's signal handlers don't belong to us
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    # don't share the parent's db connections
+    from app import reset_db_after_fork
+    reset_db_after_fork()
+
+    with Connection(redis_rq_conn):
+        worker = RecyclingWorker(
+            get_worker_queues(queue_names),
+            exc_handler=failed_job_handler,
+            max_jobs=max_jobs,
+            max_memory_mb=max_memory_mb
+        )
+        worker.work()
+
+
+def start_supervisor(queue_names, num_processes, max_jobs, max_memory_mb):
+    print "starting supervisor for {} workers on {}...".format(num_processes, queue_names)
+
+    # import everything the jobs need once, here, so every worker starts with it loaded
+    import jobs_defs
+
+    children = {}
+    shutting_down = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                run_preforked_worker(queue_names, max_jobs, max_memory_mb)
+            except SystemExit as e:
+                exit_code = e.code or 0
+            except Exception:
+                logging.exception("pre-forked worker died")
+                exit_code = 1
+            os._exit(exit_code)
+        children[pid] = True
+        print u"started worker {}".format(pid)
+
+    def shut_down(signum, frame):
+        shutting_down.append(signum)
+        for pid in children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, shut_down)
+    signal.signal(signal.SIGINT, shut_down)
+
+    for i in range(num_processes):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError:
+            # interrupted by a signal, or no children left
+            continue
+        children.pop(pid, None)
+        if shutting_down:
+            continue
+
+        print u"worker {} exited with status {}, starting another".format(pid, status)
+        if status:
+            sleep(1)  # don't spin if workers die right away
+        spawn()
+
+    print u"all workers stopped."
+
+
+
 if __name__ == '__main__':
 
     # get args from the command line:
     parser = argparse.ArgumentParser(description="Run RQ workers on a given queue.")
-    parser.add_argument('queue_number', type=int, help="the queue number you want this worker to listen on.")
+    parser.add_argument('queue_number', type=int, nargs="?", default=None,
+                        help="the queue number you want this worker to listen on.  default is all of them.")
+    parser.add_argument('--processes', type=int, default=int(os.getenv("RQ_WORKER_PROCESSES", 0)),
+                        help="run this many pre-forked workers under a supervisor, instead of forking for each job")
+    parser.add_argument('--max-jobs', type=int, default=worker_max_jobs, help="recycle a pre-forked worker after this many jobs")
+    parser.add_argument('--max-memory', type=int, default=worker_max_memory_mb, help="recycle a pre-forked worker above this many MB")
 
     args = vars(parser.parse_args())
 
-    queue_name = "ti-queue-{}".format(args["queue_number"])
+    if args["queue_number"] is None:
+        # so scaling up workers needs no config: every worker takes from every queue,
+        # starting at a different one so they don't all drain the same queue first
+        queue_names = [q.name for q in ti_queues]
+        start_index = os.getpid() % len(queue_names)
+        queue_names = queue_names[start_index:] + queue_names[:start_index]
+    else:
+        queue_names = ["ti-queue-{}".format(args["queue_number"])]
 
-    print u"Starting an RQ worker, listening on '{queue_name}'\n".format(
-        queue_name=queue_name
+    print u"Starting an RQ worker, listening on {queue_names}\n".format(
+        queue_names=queue_names
     )
-    start_worker(queue_name)
+    if args["processes"]:
+        start_supervisor(queue_names, args["processes"], args["max_jobs"], args["max_memory"])
+    else:
+        start_worker(queue_names)
 
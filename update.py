@@ -1,6 +1,7 @@
 from time import time
 from app import db
 import argparse
+import os
 from jobs import update_registry
 from util import elapsed
 
@@ -14,6 +15,16 @@ examples of calling this:
 # update everything
 python update.py Person.refresh --limit 10 --chunk 5 --rq
 
+# keep the queues topped up with everyone, resuming if a feeder was stopped
+python update.py Person.refresh --limit 10000000 --rq --feed 200
+
+# a run that can be picked up again after a crash, deploy or restart
+python update.py Person.refresh --limit 10000000 --rq --run refresh-2016-06
+python update.py Person.refresh --limit 10000000 --rq --resume refresh-2016-06
+
+# a backfill using the whole machine, no rq
+python update.py Person.assign_badges --limit 10000000 --processes 8
+
 # update one thing not using rq
 python update.py Person.refresh --orcid 0000-1111-2222-3333
 
@@ -22,13 +33,19 @@ python update.py Person.refresh --orcid 0000-1111-2222-3333
 def parse_update_optional_args(parser):
     # just for updating lots
     parser.add_argument('--limit', "-l", nargs="?", type=int, help="how many jobs to do")
-    parser.add_argument('--chunk', "-ch", nargs="?", type=int, help="how many to take off db at once")
+    parser.add_argument('--chunk', "-ch", nargs="?", type=int, help="how many to take off db at once (default: sized from past timings)")
     parser.add_argument('--after', nargs="?", type=str, help="minimum id or id start, ie 0000-0001")
     parser.add_argument('--rq', action="store_true", default=False, help="do jobs in this thread")
 
     # just for updating one
     parser.add_argument('--id', nargs="?", type=str, help="id of the one thing you want to update")
     parser.add_argument('--orcid', nargs="?", type=str, help="orcid id of the one thing you want to update")
+    parser.add_argument('--feed', nargs="?", type=int, const=int(os.getenv("UPDATE_FEED_DEPTH", 200)), default=None,
+                        help="with --rq, keep each queue topped up to this many jobs instead of enqueueing everything at once.  resumes where the last feeder stopped")
+    parser.add_argument('--run', nargs="?", type=str, help="name this run, so it can be resumed with --resume")
+    parser.add_argument('--resume', nargs="?", type=str, help="name of a run to carry on with, after a crash or restart")
+    parser.add_argument('--processes', nargs="?", type=int, help="without --rq, run the chunks in this many local processes at once")
+    parser.add_argument('--high-priority', action="store_true", default=False, help="use the high priority queue and provider lane, for refreshes someone is waiting on")
 
     # parse and run
     parsed_args = parser.parse_args()
@@ -51,7 +68,12 @@ def run_update(parsed_args):
         obj_id=parsed_args.id,  # is empty unless updating just one row
         min_id=parsed_args.after,  # is empty unless minimum id
         num_jobs=parsed_args.limit,
-        chunk_size=parsed_args.chunk
+        chunk_size=parsed_args.chunk,
+        high_priority=parsed_args.high_priority,
+        feed_depth=parsed_args.feed,
+        run_name=parsed_args.resume or parsed_args.run,
+        resume=bool(parsed_args.resume),
+        processes=parsed_args.processes
     )
 
     db.session.remove()
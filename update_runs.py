@@ -0,0 +1,114 @@
+import os
+import json
+import logging
+import redis
+from time import time
+
+from app import redis_rq_conn
+
+
+# a named update run remembers how far it got, so  update.py --resume <run>  can carry on
+# after a crash, deploy or dyno restart without redoing anything.  for each run we keep:
+#   update-run:{name}         which update it is, and the high water mark: every id up to
+#                             it has been put in a chunk
+#   update-run-chunks:{name}  the ids in each chunk, by chunk number
+#   update-run-done:{name}    a bitmap, bit n set once chunk n is finished
+run_keep_seconds = int(os.getenv("UPDATE_RUN_KEEP_SECONDS", 60 * 60 * 24 * 14))
+
+
+def run_key(run_name):
+    return u"update-run:{}".format(run_name)
+
+def run_chunks_key(run_name):
+    return u"update-run-chunks:{}".format(run_name)
+
+def run_done_key(run_name):
+    return u"update-run-done:{}".format(run_name)
+
+
+def start_run(run_name, update_name):
+    pipe = redis_rq_conn.pipeline()
+    pipe.delete(run_key(run_name), run_chunks_key(run_name), run_done_key(run_name))
+    pipe.hmset(run_key(run_name), {
+        "update": update_name,
+        "num_chunks": 0,
+        "started": time()
+    })
+    pipe.expire(run_key(run_name), run_keep_seconds)
+    pipe.execute()
+
+
+def get_run(run_name):
+    run = redis_rq_conn.hgetall(run_key(run_name))
+    if not run:
+        return None
+    run["num_chunks"] = int(run["num_chunks"])
+    run["high_water"] = run.get("high_water", None) or None
+    return run
+
+
+def add_run_chunks(run_name, obj_ids_chunks):
+    # numbers the chunks and remembers their ids.  returns the chunk numbers.
+    if not obj_ids_chunks:
+        return []
+    num_chunks = redis_rq_conn.hincrby(run_key(run_name), "num_chunks", len(obj_ids_chunks))
+    chunk_indexes = range(num_chunks - len(obj_ids_chunks), num_chunks)
+
+    pipe = redis_rq_conn.pipeline()
+    for (chunk_index, obj_ids) in zip(chunk_indexes, obj_ids_chunks):
+        pipe.hset(run_chunks_key(run_name), chunk_index, json.dumps(obj_ids))
+    pipe.expire(run_chunks_key(run_name), run_keep_seconds)
+    pipe.execute()
+    return chunk_indexes
+
+
+def set_run_high_water(run_name, last_id):
+    redis_rq_conn.hset(run_key(run_name), "high_water", last_id)
+
+
+def mark_run_chunks_done(run_name, chunk_indexes):
+    try:
+        pipe = redis_rq_conn.pipeline()
+        for chunk_index in chunk_indexes:
+            pipe.setbit(run_done_key(run_name), chunk_index, 1)
+        pipe.expire(run_done_key(run_name), run_keep_seconds)
+        pipe.execute()
+    except redis.RedisError:
+        # worst case, a resume redoes this chunk
+        logging.exception(u"couldn't mark chunks {} of run {} done".format(chunk_indexes, run_name))
+
+
+def get_unfinished_run_chunks(run_name):
+    # {chunk number: ids} for every chunk that was started but isn't done
+    run = get_run(run_name)
+    if not run or not run["num_chunks"]:
+        return {}
+
+    done_bitmap = redis_rq_conn.get(run_done_key(run_name)) or ""
+    unfinished_indexes = []
+    for chunk_index in range(run["num_chunks"]):
+        byte_index = chunk_index / 8
+        is_done = byte_index < len(done_bitmap) and ord(done_bitmap[byte_index]) & (128 >> (chunk_index % 8))
+        if not is_done:
+            unfinished_indexes.append(chunk_index)
+
+    if not unfinished_indexes:
+        return {}
+    chunks_json = redis_rq_conn.hmget(run_chunks_key(run_name), unfinished_indexes)
+    return dict([(chunk_index, json.loads(chunk_json))
+                 for (chunk_index, chunk_json) in zip(unfinished_indexes, chunks_json) if chunk_json])
+
+
+def run_status(run_name):
+    run = get_run(run_name)
+    if not run:
+        return None
+    run["num_done"] = redis_rq_conn.bitcount(run_done_key(run_name))
+    return run
+
+
+
+if __name__ == "__main__":
+    # python update_runs.py <run>   shows how far a run has got
+    import sys
+    print json.dumps(run_status(sys.argv[1]), sort_keys=True, indent=4)
@@ -11,9 +11,30 @@ import re
 import string
 import collections
 import csv
+import json
+import hashlib
 from functools import wraps
 
 
+def fingerprint(*things):
+    """
+    Short stable hash of any json-able things, for noticing when inputs have changed.
+    """
+    as_json = json.dumps(things, sort_keys=True, default=unicode)
+    return hashlib.md5(as_json).hexdigest()
+
+
+def json_dumper(obj):
+    """
+    if the obj has a to_dict() function we've implemented, uses it to get dict.
+    from http://stackoverflow.com/a/28174796
+    """
+    try:
+        return obj.to_dict()
+    except AttributeError:
+        return obj.__dict__
+
+
 def read_csv_file(filename):
     print filename
     with open(filename, "r") as csv_file:
@@ -358,6 +379,27 @@ def chunks(l, n):
     for i in xrange(0, len(l), n):
         yield l[i:i+n]
 
+class ConsistentHashRing(object):
+    """
+    Maps keys to nodes so adding or removing a node only moves about 1/n of the keys.
+    Each node gets `replicas` points on the ring, to even out the spread.
+    """
+    def __init__(self, nodes, replicas=100):
+        self.ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self.ring.append((self.hash_key(u"{}:{}".format(node, i)), node))
+        self.ring.sort()
+        self.ring_hashes = [ring_hash for (ring_hash, node) in self.ring]
+
+    def hash_key(self, key):
+        return int(hashlib.md5(unicode(key).encode("utf-8")).hexdigest()[0:8], 16)
+
+    def get_node(self, key):
+        index = bisect.bisect(self.ring_hashes, self.hash_key(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
 def page_query(q, page_size=1000):
     offset = 0
     while True:
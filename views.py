@@ -18,16 +18,25 @@ from models.person import make_temporary_person_from_orcid
 from models.person import top_acheivement_persons, avg_openess, get_sources
 from models.log_temp_profile import add_new_log_temp_profile
 from models.person import get_random_people
+from models.person import get_profile_json
+from models.person import save_profile_json
 from models.product import Product
 from models.product import get_all_products
+from models.load_profiles import with_load_profile
 from models.refset import num_people_in_db
 from models.badge import Badge
 from models.badge import badge_configs
 from models.search import autocomplete
 from models.url_slugs_to_redirect import url_slugs_to_redirect
 from models.twitter import get_twitter_creds
+from job_metrics import get_job_metrics
+from profile_cache import get_cached_profile
+from profile_cache import cache_profile
+from profile_cache import get_cached_twitter_lookup
+from profile_cache import cache_twitter_lookup
 from util import safe_commit, get_badge_description
 from util import elapsed
+from util import json_dumper
 
 from flask import make_response
 from flask import request
@@ -58,17 +67,6 @@ from time import time
 logger = logging.getLogger("views")
 
 
-def json_dumper(obj):
-    """
-    if the obj has a to_dict() function we've implemented, uses it to get dict.
-    from http://stackoverflow.com/a/28174796
-    """
-    try:
-        return obj.to_dict()
-    except AttributeError:
-        return obj.__dict__
-
-
 def json_resp(thing):
     # hide_keys = request.args.get("hide", "").split(",")
     # if hide_keys:
@@ -79,7 +77,11 @@ def json_resp(thing):
     #             pass
 
     json_str = json.dumps(thing, sort_keys=True, default=json_dumper, indent=4)
+    return json_str_resp(json_str)
+
 
+def json_str_resp(json_str):
+    # for json that's already serialized, like the stored profile snapshots
     if request.path.endswith(".json") and (os.getenv("FLASK_DEBUG", False) == "True"):
         logger.info(u"rendering output through debug_api.html template")
         resp = make_response(render_template(
@@ -92,6 +94,37 @@ def json_resp(thing):
     return resp
 
 
+def etag_json_resp(json_str, etag):
+    # a 304 if they've already got this one
+    resp = json_str_resp(json_str)
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+
+def profile_resp(orcid_id):
+    """
+    The profile of someone in the db, with an etag: from the redis cache if it's
+    there for their current updated (see profile_cache.py), otherwise the snapshot
+    calculate stored, otherwise built live.  None if they aren't in the db.
+    """
+    row = db.session.query(Person.updated).filter_by(orcid_id=orcid_id).first()
+    if not row:
+        return None
+    updated = row[0]
+
+    cached = get_cached_profile(orcid_id, updated)
+    if cached:
+        return etag_json_resp(cached["body"], cached["etag"])
+
+    profile_json = get_profile_json(orcid_id)
+    if not profile_json:
+        my_person = with_load_profile(Person.query, "api-view").filter_by(orcid_id=orcid_id).first()
+        profile_json = save_profile_json(my_person)
+
+    etag = cache_profile(orcid_id, updated, profile_json)
+    return etag_json_resp(profile_json, etag)
+
+
 def abort_json(status_code, msg, **kwargs):
     body_dict = {
         "message": msg
@@ -197,7 +230,7 @@ def group():
     if not isinstance(achievement_names, list):
         achievement_names = [achievement_names]
 
-    persons = (Person.query.filter(Person.orcid_id.in_(person_ids))
+    persons = (with_load_profile(Person.query, "api-view").filter(Person.orcid_id.in_(person_ids))
                .order_by(Person.openness.desc())
                .all())
     products = Product.query.filter(Product.orcid_id.in_(person_ids)).all()
@@ -256,17 +289,15 @@ def group():
 @app.route("/api/person/<orcid_id>/polling")
 @app.route("/api/person/<orcid_id>/polling.json")
 def profile_endpoint_polling(orcid_id):
-    my_person = Person.query.filter_by(orcid_id=orcid_id).first()
-
-    return json_resp(my_person.to_dict())
+    resp = profile_resp(orcid_id)
+    if not resp:
+        abort_json(404, "We don't have that ORCID in the db.")
+    return resp
 
 
 @app.route("/api/person/<orcid_id>")
 @app.route("/api/person/<orcid_id>.json")
 def profile_endpoint(orcid_id):
-    my_person = Person.query.filter_by(orcid_id=orcid_id).first()
-
-
     # the right was to do this is save an is_deleted flag in the db and check it here.
     # this will work for now.
     deleted_orcid_ids = [
@@ -277,24 +308,28 @@ def profile_endpoint(orcid_id):
     if orcid_id in deleted_orcid_ids:
         abort_json(404, "This user is deleted")
 
-    if not my_person:
-        if not request.args.get("source"):
-            if request.headers.getlist("X-Forwarded-For"):
-                ip = request.headers.getlist("X-Forwarded-For")[0]
-                if ip == "54.210.209.20":
-                    abort_json(429, """We've noticed you are making many requests.
+    resp = profile_resp(orcid_id)
+    if resp:
+        return resp
+
+    # not in the db, so make a temporary profile straight from orcid
+    if not request.args.get("source"):
+        if request.headers.getlist("X-Forwarded-For"):
+            ip = request.headers.getlist("X-Forwarded-For")[0]
+            if ip == "54.210.209.20":
+                abort_json(429, """We've noticed you are making many requests.
                                     Please add ?source=YOUREMAILADDRESS to your API calls,
                                     or email us at team@impactstory.org for more details on
                                     our API. Thanks!""")
 
-        print u"making temporary person for {orcid_id}, referred by {referrer} using url {url}, ip {ip}".format(
-            orcid_id=orcid_id,
-            referrer=request.referrer,
-            url=request.url,
-            ip=request.remote_addr)
-        my_person = make_temporary_person_from_orcid(orcid_id)
-        print u"saving log_temp_profile for {}".format(my_person)
-        temp_profile_log = add_new_log_temp_profile(my_person, request)
+    print u"making temporary person for {orcid_id}, referred by {referrer} using url {url}, ip {ip}".format(
+        orcid_id=orcid_id,
+        referrer=request.referrer,
+        url=request.url,
+        ip=request.remote_addr)
+    my_person = make_temporary_person_from_orcid(orcid_id)
+    print u"saving log_temp_profile for {}".format(my_person)
+    temp_profile_log = add_new_log_temp_profile(my_person, request)
 
     return json_resp(my_person.to_dict())
 
@@ -304,18 +339,24 @@ def profile_endpoint(orcid_id):
 @app.route("/api/person/twitter_screen_name/<screen_name>")
 @app.route("/api/person/twitter_screen_name/<screen_name>.json")
 def profile_endpoint_twitter(screen_name):
+    cached = get_cached_twitter_lookup(screen_name)
+    if cached:
+        return etag_json_resp(cached["body"], cached["etag"])
+
     res = db.session.query(Person.orcid_id).filter_by(twitter=screen_name).first()
     if not res:
         abort_json(404, "We don't have anyone with that twitter screen name")
 
-    return json_resp({"id": res[0]})
+    json_str = json.dumps({"id": res[0]}, sort_keys=True, default=json_dumper, indent=4)
+    etag = cache_twitter_lookup(screen_name, json_str)
+    return etag_json_resp(json_str, etag)
 
 
 # need to call it with https for it to work
 @app.route("/api/person/<orcid_id>", methods=["POST"])
 @app.route("/api/person/<orcid_id>.json", methods=["POST"])
 def modify_profile_endpoint(orcid_id):
-    my_person = Person.query.filter_by(orcid_id=orcid_id).first()
+    my_person = with_load_profile(Person.query, "api-view").filter_by(orcid_id=orcid_id).first()
 
     product_id = request.json["product"]["id"]
     my_product = next(my_product for my_product in my_person.products if my_product.id==product_id)
@@ -323,17 +364,18 @@ def modify_profile_endpoint(orcid_id):
     my_product.set_oa_from_user_supplied_fulltext_url(url)
 
     my_person.recalculate_openness()
+    profile_json = my_person.set_profile_json()
 
     safe_commit(db)
 
-    return json_resp(my_person.to_dict())
+    return json_str_resp(profile_json)
 
 
 
 @app.route("/api/person/<orcid_id>/refresh", methods=["POST"])
 @app.route("/api/person/<orcid_id>/refresh.json", methods=["POST"])
 def refresh_profile_endpoint(orcid_id):
-    my_person = refresh_profile(orcid_id)
+    my_person = refresh_profile(orcid_id, high_priority=True)
     return json_resp(my_person.to_dict())
 
 
@@ -342,15 +384,16 @@ def refresh_profile_endpoint(orcid_id):
 @app.route("/api/person/<orcid_id>/fulltext", methods=["POST"])
 @app.route("/api/person/<orcid_id>/fulltext.json", methods=["POST"])
 def refresh_fulltext(orcid_id):
-    my_person = Person.query.filter_by(orcid_id=orcid_id).first()
+    my_person = with_load_profile(Person.query, "api-view").filter_by(orcid_id=orcid_id).first()
     my_person.recalculate_openness()
+    profile_json = my_person.set_profile_json()
     safe_commit(db)
-    return json_resp(my_person.to_dict())
+    return json_str_resp(profile_json)
 
 
 @app.route("/api/person/<orcid_id>/tweeted-quickly", methods=["POST"])
 def tweeted_quickly(orcid_id):
-    my_person = Person.query.filter_by(orcid_id=orcid_id).first()
+    my_person = with_load_profile(Person.query, "auth").filter_by(orcid_id=orcid_id).first()
 
     if not my_person:
             print u"returning 404: orcid profile {} does not exist".format(orcid_id)
@@ -455,13 +498,13 @@ def login_required(f):
         g.my_person = None
         if "id" in payload:
             # this uses the current token format
-            g.my_person = Person.query.filter_by(id=payload["id"]).first()
+            g.my_person = with_load_profile(Person.query, "auth").filter_by(id=payload["id"]).first()
         if not g.my_person and "orcid_id" in payload:
             # fallback because some tokens don't have id?
-            g.my_person = Person.query.filter_by(orcid_id=payload["orcid_id"]).first()
+            g.my_person = with_load_profile(Person.query, "auth").filter_by(orcid_id=payload["orcid_id"]).first()
         if not g.my_person and "sub" in payload:
             # fallback for old token format
-            g.my_person = Person.query.filter_by(orcid_id=payload["sub"]).first()
+            g.my_person = with_load_profile(Person.query, "auth").filter_by(orcid_id=payload["sub"]).first()
         if not g.my_person:
             print u"in login_required with error, no known keys in token payload: {}".format(payload)
 
@@ -492,7 +535,7 @@ def me():
 @app.route("/api/me/refresh", methods=["POST"])
 @login_required
 def refresh_me():
-    refresh_person(g.my_person)
+    refresh_person(g.my_person, high_priority=True)
     return jsonify({"token":  g.my_person.get_token()})
 
 @app.route("/api/me/promos", methods=["GET"])
@@ -513,7 +556,7 @@ def orcid_login():
         print u"in orcid_login with error, no my_orcid_id"
         abort_json(401, "Bad ORCID response; the auth code you sent is probably expired.")
 
-    my_person = Person.query.filter_by(orcid_id=my_orcid_id).first()
+    my_person = with_load_profile(Person.query, "auth").filter_by(orcid_id=my_orcid_id).first()
     if not my_person:
         print u"in orcid_login with error, no my_person"
         abort_json(
@@ -558,7 +601,7 @@ def twitter_login():
         print u"error in twitter_login, empty twitter creds"
         abort_json(422, "empty twitter creds")
 
-    my_person = Person.query.filter_by(twitter=twitter_creds["screen_name"]).first()
+    my_person = with_load_profile(Person.query, "auth").filter_by(twitter=twitter_creds["screen_name"]).first()
     if not my_person:
         abort_json(
             404,
@@ -581,7 +624,7 @@ def twitter_register_but_login_if_they_are_already_registered():
     try:
         my_person = make_person(twitter_creds, landing_page=landing_page)
     except PersonExistsException:
-        my_person = Person.query.filter_by(twitter=twitter_creds["screen_name"]).first()
+        my_person = with_load_profile(Person.query, "auth").filter_by(twitter=twitter_creds["screen_name"]).first()
 
     return jsonify({"token": my_person.get_token()})
 
@@ -629,6 +672,13 @@ def get_twitter_request_token():
 ##########
 # admin
 
+@app.route("/admin/jobs", methods=["GET"])
+def job_metrics_endpoint():
+    # throughput, latency percentiles and stage timings the workers recorded, see job_metrics.py
+    minutes = int(request.args.get("minutes", 60))
+    return json_resp(get_job_metrics(minutes=minutes, update_name=request.args.get("update", None)))
+
+
 @app.route("/admin/random/<n>", methods=["GET"])
 def random_people(n):
     people = get_random_people(n)